@@ -0,0 +1,384 @@
+"""Load test the bot's real handlers against a fake Bot API server and a local database.
+
+Generates a synthetic campaign (viral invite trees of signed /start links,
+channel joins, wish writes, wallet binds, invitee lookups and admin "实现愿望" flows),
+feeds it through the dispatcher as fast as it is consumed and reports throughput, handler
+latency, SQL statements and Bot API calls per update.
+
+The database is wiped before the run, point it at a scratch MySQL database:
+
+    docker run -d -p 3306:3306 -e MYSQL_ALLOW_EMPTY_PASSWORD=yes -e MYSQL_DATABASE=lantern_loadtest mysql:8
+    python loadtest.py --database-url mysql+mysqlconnector://root@127.0.0.1/lantern_loadtest?charset=utf8mb4 --users 5000 --save-baseline baseline.json
+    python loadtest.py --database-url ... --users 5000 --baseline baseline.json
+"""
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import threading
+import time
+
+load_dotenv()
+
+BOT_ID = 999
+ADMIN_ID = 1
+CHANNEL_ID = -1001
+GROUP_ID = -1002
+ADMIN_GROUP_ID = -1003
+FIRST_USER_ID = 10_000_000
+
+# Metric name -> whether a higher value is better, used when comparing with a baseline
+METRICS = {
+    'throughput': True,
+    'latency_p50_ms': False,
+    'latency_p95_ms': False,
+    'latency_p99_ms': False,
+    'statements_per_update': False,
+    'api_calls_per_update': False,
+}
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Answers Bot API methods the bot uses with plausible results."""
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        method = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        params = json.loads(self.rfile.read(length)) if length else {}
+        status, body = self.server.call(method, params)
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeBotApi(ThreadingHTTPServer):
+    """Local stand-in for api.telegram.org with configurable latency and flood limits.
+
+    latency is the mean response time in seconds, each call takes 50-150% of it.
+    retry_after_rate is the share of sendMessage and editMessageText calls answered
+    with 429 and a retry_after of retry_after seconds.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    CHATS = {
+        CHANNEL_ID: {'id': CHANNEL_ID, 'type': 'channel', 'title': 'Lantern Channel', 'username': 'lantern_loadtest_channel', 'invite_link': 'https://t.me/+loadtest'},
+        GROUP_ID: {'id': GROUP_ID, 'type': 'supergroup', 'title': 'Lantern Group', 'invite_link': 'https://t.me/+loadtestgroup'},
+        ADMIN_GROUP_ID: {'id': ADMIN_GROUP_ID, 'type': 'supergroup', 'title': 'Lantern Admins'},
+    }
+
+    def __init__(self, latency: float = 0.05, retry_after_rate: float = 0.0, retry_after: int = 1):
+        super().__init__(('127.0.0.1', 0), FakeBotApiHandler)
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.members = set()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.message_ids = iter(range(1, sys.maxsize))
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/bot'
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, name='fake-bot-api', daemon=True).start()
+
+    def chat(self, chat_id) -> dict:
+        if str(chat_id).startswith('@'):
+            return self.CHATS[CHANNEL_ID]
+        chat_id = int(chat_id)
+        return self.CHATS.get(chat_id) or {'id': chat_id, 'type': 'private', 'first_name': f'User{chat_id}'}
+
+    def call(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] += 1
+            message_id = next(self.message_ids)
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if method in ('sendMessage', 'editMessageText') and random.random() < self.retry_after_rate:
+            with self.lock:
+                self.calls['retry_after'] += 1
+            return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}', 'parameters': {'retry_after': self.retry_after}}
+        if method == 'getMe':
+            result = {'id': BOT_ID, 'is_bot': True, 'first_name': 'Lantern', 'username': 'lantern_loadtest_bot'}
+        elif method == 'getChat':
+            result = self.chat(params['chat_id'])
+        elif method == 'getChatMember':
+            user_id = int(params['user_id'])
+            result = {'user': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}, 'status': 'member' if user_id in self.members else 'left'}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {'message_id': int(params.get('message_id') or message_id), 'date': int(time.time()), 'chat': self.chat(params['chat_id']), 'text': params.get('text', '')}
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def api_calls(self) -> int:
+        with self.lock:
+            return sum(count for method, count in self.calls.items() if method != 'retry_after')
+
+class Campaign:
+    """Builds a synthetic campaign as a time ordered list of (kind, update JSON)."""
+
+    def __init__(self, rng: random.Random, api: FakeBotApi, invite_payload):
+        self.rng = rng
+        self.api = api
+        self.invite_payload = invite_payload
+        self.events = []
+        self.update_ids = iter(range(1, sys.maxsize))
+
+    def user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, at: float, kind: str, user_id: int, text: str) -> None:
+        update_id = next(self.update_ids)
+        message = {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': self.user(user_id), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.events.append((at, kind, {'update_id': update_id, 'message': message}))
+
+    def channel_join(self, at: float, user_id: int) -> None:
+        member = self.user(user_id)
+        self.events.append((at, 'chat_member', {'update_id': next(self.update_ids), 'chat_member': {
+            'chat': FakeBotApi.CHATS[CHANNEL_ID], 'from': member, 'date': int(time.time()),
+            'old_chat_member': {'user': member, 'status': 'left'},
+            'new_chat_member': {'user': member, 'status': 'member'},
+        }}))
+
+    def generate(self, users: int, seeds: int, subscribe_rate: float, wish_rate: float, wallet_rate: float, claims: int) -> list:
+        rng = self.rng
+        # Preferential attachment: every user holds one ticket plus one per invitee, so a few links go viral
+        tickets = []
+        wishers = []
+        for i in range(users):
+            user_id = FIRST_USER_ID + i
+            at = float(i)
+            inviter = rng.choice(tickets) if i >= seeds else None
+            start = f'/start {self.invite_payload(inviter)}' if inviter else '/start'
+            self.message(at, 'start', user_id, start)
+            if inviter:
+                tickets.append(inviter)
+            tickets.append(user_id)
+
+            subscribed = rng.random() < subscribe_rate
+            if subscribed:
+                if rng.random() < 0.3:
+                    # Joins the channel after being asked to
+                    at += rng.expovariate(1 / 2)
+                    self.channel_join(at, user_id)
+                else:
+                    self.api.members.add(user_id)
+            if inviter and rng.random() < 0.1:
+                at += rng.expovariate(1 / 5)
+                self.message(at, 'start', user_id, start)
+            wishes = rng.random() < wish_rate
+            # The bot asks for a wallet address before taking a wish
+            if wishes or rng.random() < wallet_rate:
+                at += rng.expovariate(1 / 5)
+                self.message(at, 'wallet', user_id, '🧧绑定钱包')
+                at += rng.expovariate(1 / 5)
+                self.message(at, 'wallet', user_id, 'T' + ''.join(rng.choices(string.ascii_letters + string.digits, k=33)))
+            if wishes:
+                at += rng.expovariate(1 / 5)
+                self.message(at, 'wish', user_id, '🏮写下愿望')
+                at += rng.expovariate(1 / 5)
+                self.message(at, 'wish', user_id, f'愿望 {user_id}')
+                if subscribed:
+                    # Only channel members get to write a wish
+                    wishers.append((at, user_id))
+            if rng.random() < 0.3:
+                at += rng.expovariate(1 / 5)
+                self.message(at, 'invitees', user_id, '🥣我的邀请')
+
+        # Admin flows run one after another over the second half of the campaign
+        for j in range(claims):
+            at = users * (0.5 + 0.5 * j / max(claims, 1))
+            # Shards run concurrently, leave the wish time to be handled before an admin looks it up
+            candidates = [user_id for wished_at, user_id in wishers if wished_at < at - 100]
+            if not candidates:
+                continue
+            self.message(at, 'admin', ADMIN_ID, '🌟实现愿望')
+            self.message(at + 0.001, 'admin', ADMIN_ID, str(rng.choice(candidates)))
+            self.message(at + 0.002, 'admin', ADMIN_ID, f'备注 {j}')
+
+        self.events.sort(key=lambda event: event[0])
+        return [(kind, update) for _, kind, update in self.events]
+
+class Recorder:
+    """Collects per update handler latency and statement counts."""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.samples = defaultdict(list)
+        self.kinds = {}
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.finished_at = None
+
+    def add(self, update, elapsed: float, statements: int) -> None:
+        with self.lock:
+            self.samples[self.kinds.get(update.update_id, 'other')].append((elapsed, statements))
+            self.count += 1
+            if self.count >= self.expected:
+                self.finished_at = time.perf_counter()
+                self.done.set()
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def summarize(samples) -> dict:
+    latencies = [elapsed for elapsed, _ in samples]
+    return {
+        'updates': len(samples),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'latency_p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'statements_per_update': round(sum(statements for _, statements in samples) / max(len(samples), 1), 2),
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the change of every metric and return whether none regressed beyond tolerance percent."""
+    ok = True
+    print(f"\n{'metric':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better in METRICS.items():
+        before, after = baseline.get(name), results[name]
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        regressed = (change < -tolerance) if higher_is_better else (change > tolerance)
+        ok = ok and not regressed
+        print(f"{name:<24}{before:>12}{after:>12}{change:>+9.1f}%{'  REGRESSED' if regressed else ''}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('LOADTEST_DATABASE_URL'), required=not os.getenv('LOADTEST_DATABASE_URL'),
+                        help='scratch database, all of its bot tables are dropped (default: LOADTEST_DATABASE_URL)')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--seeds', type=int, default=20, help='users who start without an invite link')
+    parser.add_argument('--subscribe-rate', type=float, default=0.7)
+    parser.add_argument('--wish-rate', type=float, default=0.5)
+    parser.add_argument('--wallet-rate', type=float, default=0.2, help='share of users binding a wallet without making a wish')
+    parser.add_argument('--claims', type=int, default=20, help='admin 实现愿望 flows')
+    parser.add_argument('--api-latency', type=float, default=50, help='mean fake Bot API latency in ms')
+    parser.add_argument('--retry-after-rate', type=float, default=0.01, help='share of sends answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of injected 429s in seconds')
+    parser.add_argument('--send-rate', type=float, default=1000, help='outbox rate limits in messages per second')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline')
+    parser.add_argument('--baseline', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=10, help='allowed regression against the baseline in percent')
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.api_latency / 1000, args.retry_after_rate, args.retry_after)
+    api.start()
+
+    # main reads its configuration at import time
+    os.environ.update({
+        'BOT_TOKEN': '123456:loadtest',
+        'BOT_API_URL': api.url,
+        'DATABASE_URL': args.database_url,
+        'ADMIN_IDS': str(ADMIN_ID),
+        'CHANNEL_NAME': '@lantern_loadtest_channel',
+        'GROUP_ID': str(GROUP_ID),
+        'ADMIN_GROUP_ID': str(ADMIN_GROUP_ID),
+        'METADATA_CACHE_FILE': os.path.join(tempfile.mkdtemp(), 'metadata.json'),
+        'GLOBAL_SEND_RATE': str(args.send_rate),
+        'PRIVATE_SEND_RATE': str(args.send_rate),
+        'GROUP_SEND_RATE_PER_MINUTE': str(args.send_rate * 60),
+        # The campaign is replayed faster than real users type, every update has to reach the handlers
+        'USER_RATE_LIMIT': '0',
+        'OVERLOAD_QUEUE_DEPTH': '0',
+        'OVERLOAD_P99': '0',
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import main as bot_main
+    from telegram import Update
+
+    bot_main.Base.metadata.drop_all(bot_main.engine)
+    updater = bot_main.create_app()
+    dispatcher = updater.dispatcher
+    bot_main.outbox.start()
+    startup_calls = api.api_calls()
+
+    campaign = Campaign(random.Random(args.seed), api, bot_main.invite_payload).generate(args.users, args.seeds, args.subscribe_rate, args.wish_rate, args.wallet_rate, args.claims)
+    updates = [(kind, Update.de_json(update, bot_main.bot)) for kind, update in campaign]
+    recorder = Recorder(len(updates))
+    recorder.kinds = {update.update_id: kind for kind, update in updates}
+
+    handle_update = bot_main.UnitOfWorkDispatcher.handle_update
+
+    def measured_handle_update(self, update):
+        started = time.perf_counter()
+        handle_update(self, update)
+        # db_context.statements is reset per update by update_scope() on this thread
+        recorder.add(update, time.perf_counter() - started, bot_main.db_context.statements)
+
+    bot_main.UnitOfWorkDispatcher.handle_update = measured_handle_update
+
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    print(f'Replaying {len(updates)} updates from {args.users} users')
+    started = time.perf_counter()
+    for _, update in updates:
+        dispatcher.update_queue.put(update)
+    if not recorder.done.wait(args.timeout):
+        print(f'Timed out with {recorder.count} of {len(updates)} updates handled')
+        sys.exit(2)
+    elapsed = recorder.finished_at - started
+
+    # Let the outbox deliver everything the handlers queued before counting Bot API calls
+    dispatcher.stop()
+    bot_main.scheduler.shutdown()
+    bot_main.persistence.flush()
+    bot_main.flush_dashboard()
+    bot_main.write_behind.flush(wait=True)
+    bot_main.campaign_stats.flush()
+    bot_main.outbox.stop()
+    api_calls = api.api_calls() - startup_calls
+
+    all_samples = [sample for samples in recorder.samples.values() for sample in samples]
+    results = dict(summarize(all_samples), **{
+        'throughput': round(len(all_samples) / elapsed, 1),
+        'api_calls_per_update': round(api_calls / len(all_samples), 2),
+        'api_calls': dict(api.calls),
+        'by_kind': {kind: summarize(samples) for kind, samples in sorted(recorder.samples.items())},
+        'config': {name: value for name, value in vars(args).items() if name not in ('database_url', 'timeout', 'output', 'save_baseline', 'baseline', 'tolerance')},
+    })
+
+    print(f"{results['updates']} updates in {elapsed:.2f}s ({results['throughput']} updates/s)")
+    print(f"handler latency p50={results['latency_p50_ms']}ms p95={results['latency_p95_ms']}ms p99={results['latency_p99_ms']}ms")
+    print(f"{results['statements_per_update']} SQL statements and {results['api_calls_per_update']} Bot API calls per update")
+    print(f"Bot API calls: {', '.join(f'{method}={count}' for method, count in sorted(api.calls.items()))}")
+    print(f"\n{'kind':<14}{'updates':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'stmts':>8}")
+    for kind, summary in results['by_kind'].items():
+        print(f"{kind:<14}{summary['updates']:>9}{summary['latency_p50_ms']:>9}{summary['latency_p95_ms']:>9}{summary['latency_p99_ms']:>9}{summary['statements_per_update']:>8}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print('\nWarning: the baseline was recorded with a different configuration')
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
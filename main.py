@@ -1,37 +1,333 @@
-from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters, ConversationHandler
-from telegram.error import BadRequest, RetryAfter
+from telegram import Bot, Chat, MessageEntity, User as TelegramUser, Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
+from telegram.ext import Updater, Dispatcher, BasePersistence, CommandHandler, CallbackQueryHandler, ChatMemberHandler, CallbackContext, MessageHandler, Filters, ConversationHandler
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
 from telegram.utils.request import Request
-from sqlalchemy import create_engine, Column, String, Enum, Integer, BigInteger, ForeignKey, DateTime, Boolean, Index
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, backref
+from sqlalchemy import create_engine, event, inspect, select, text, and_, case, extract, or_, Column, String, Enum, Integer, BigInteger, ForeignKey, DateTime, Boolean, Text, Index, UniqueConstraint
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship, backref, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import func
 from contextlib import contextmanager
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
+import pytz
+import argparse
+import base64
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import hmac
+import html
+import json
 import logging
 import random
-import string
+import re
 import os
+import sys
 import time
+import threading
+import heapq
+import itertools
+import signal
+import tempfile
+import traceback
+import warnings
+from queue import Queue, Empty, Full
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 load_dotenv()
 
-# Setup the bot
-request = Request(con_pool_size=20)
-bot = Bot(token=os.getenv('BOT_TOKEN'), request=request)
-admin_group_info = bot.getChat(chat_id=os.getenv('ADMIN_GROUP_ID'))
-group_info = bot.getChat(chat_id=os.getenv('GROUP_ID'))
-channel_info = bot.getChat(chat_id=os.getenv('CHANNEL_NAME'))
-
-# Setup scheduler
-scheduler = BackgroundScheduler()
-scheduler.start()
+# Dispatcher settings
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 8))
+DISPATCH_QUEUE_SIZE = int(os.getenv('DISPATCH_QUEUE_SIZE', 100))
+
+# Cache settings
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', 300))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', 100000))
+USER_CACHE_ENABLED = os.getenv('USER_CACHE_ENABLED', 'true').lower() == 'true'
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 600))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 50000))
+USER_CACHE_SYNC_INTERVAL = float(os.getenv('USER_CACHE_SYNC_INTERVAL', 2))  # drops users other processes changed
+
+# Admin-group dashboard refresh window in seconds
+DASHBOARD_FLUSH_INTERVAL = float(os.getenv('DASHBOARD_FLUSH_INTERVAL', 10))
+
+# Database connection pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', DISPATCH_WORKERS + 4))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+# Outbound rate limits, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', 30))
+GROUP_SEND_RATE = float(os.getenv('GROUP_SEND_RATE_PER_MINUTE', 20)) / 60
+PRIVATE_SEND_RATE = float(os.getenv('PRIVATE_SEND_RATE', 1))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 5))
+# Flood waits from this many chats within the window mean the bot-wide limit was hit, pausing every send
+GLOBAL_FLOOD_CHATS = int(os.getenv('GLOBAL_FLOOD_CHATS', 3))
+GLOBAL_FLOOD_WINDOW = float(os.getenv('GLOBAL_FLOOD_WINDOW', 1))
+
+# Serving mode, 'polling' for development or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # public base URL Telegram posts to
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # required in webhook mode
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv('WEBHOOK_ENQUEUE_TIMEOUT', 5))
+WEBHOOK_RECORD_FILE = os.getenv('WEBHOOK_RECORD_FILE')  # append raw updates here for replaying
+
+# Bot and chat metadata cache
+METADATA_CACHE_FILE = os.getenv('METADATA_CACHE_FILE', '.bot_metadata.json')
+METADATA_REFRESH_INTERVAL = int(os.getenv('METADATA_REFRESH_INTERVAL', 3600))
+
+# Bot API endpoint, point it at a local Bot API server or the load test's fake one
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org/bot')
+
+# Conversation persistence, sync() flushes this often and picks up states other replicas wrote since the last run
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', 1))
+PERSISTENCE_CACHE_SIZE = int(os.getenv('PERSISTENCE_CACHE_SIZE', 50000))  # users whose states are held in memory
+
+# Background channel membership sweep, SUBSCRIPTION_SWEEP_INTERVAL=0 disables it
+SUBSCRIPTION_SWEEP_INTERVAL = int(os.getenv('SUBSCRIPTION_SWEEP_INTERVAL', 60))
+SUBSCRIPTION_SWEEP_BUDGET = int(os.getenv('SUBSCRIPTION_SWEEP_BUDGET', 200))  # getChatMember calls per run
+SUBSCRIPTION_SWEEP_RATE = float(os.getenv('SUBSCRIPTION_SWEEP_RATE', 5))  # getChatMember calls per second
+SUBSCRIPTION_SWEEP_BATCH = int(os.getenv('SUBSCRIPTION_SWEEP_BATCH', 100))
+
+# Write-behind of low-value user fields
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', 2))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', 500))  # pending users that trigger an early flush
+
+# Admin broadcasts
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 1000))  # recipients read per keyset page
+BROADCAST_WINDOW = int(os.getenv('BROADCAST_WINDOW', 2 * GLOBAL_SEND_RATE))  # sends queued in the outbox at once
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 10))
+BROADCAST_LEASE = int(os.getenv('BROADCAST_LEASE', 60))  # seconds without a checkpoint before another process resumes it
+
+# Inviter leaderboard
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))
+LEADERBOARD_CACHE_TTL = float(os.getenv('LEADERBOARD_CACHE_TTL', 30))
+LEADERBOARD_RELOAD_INTERVAL = int(os.getenv('LEADERBOARD_RELOAD_INTERVAL', 60))  # picks up invites recorded by other processes
+
+# Winner draw pool, rebuilt in full on this interval to pick up writes of other processes
+DRAW_POOL_RELOAD_INTERVAL = int(os.getenv('DRAW_POOL_RELOAD_INTERVAL', 3600))
+
+# Invite links carry an HMAC of the inviter ID, keyed by INVITE_SECRET or else the bot token
+INVITE_SECRET = os.getenv('INVITE_SECRET', '')
+INVITE_CAMPAIGN = os.getenv('INVITE_CAMPAIGN', 'lf1')  # tag signed into new links, letters and digits only
+INVITE_CAMPAIGNS = set(os.getenv('INVITE_CAMPAIGNS', INVITE_CAMPAIGN).split(','))  # tags still accepted
+# Unsigned <user_id>_XXXXX links are refused unless set to a YYYY-MM-DD grace period,
+# then those of users already issued one are accepted through that day
+INVITE_LEGACY_UNTIL = os.getenv('INVITE_LEGACY_UNTIL', '')
+
+# Campaign statistics, counted in memory and upserted into stat_rollups
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', 5))
+STATS_RECONCILE_INTERVAL = int(os.getenv('STATS_RECONCILE_INTERVAL', 3600))  # full recount correcting drift
+STATS_HOURS = int(os.getenv('STATS_HOURS', 12))  # hourly buckets shown by /stats
+
+# Welcome poems, rendered once at start-up and re-read when the file changes
+POEMS_FILE = os.getenv('POEMS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poems.json'))
+POEMS_RELOAD_INTERVAL = int(os.getenv('POEMS_RELOAD_INTERVAL', 60))
+POEM_SPACING = int(os.getenv('POEM_SPACING', 2))  # full-width spaces between columns, 0-3
+
+# Admin lookup of users by ID, @username or wallet address prefix
+LOOKUP_PAGE_SIZE = int(os.getenv('LOOKUP_PAGE_SIZE', 8))
+LOOKUP_MIN_PREFIX = int(os.getenv('LOOKUP_MIN_PREFIX', 3))  # shorter prefixes match too much of the table
+LOOKUP_CACHE_TTL = float(os.getenv('LOOKUP_CACHE_TTL', 30))
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 1000))
+
+# Exports, users read per keyset page
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# Inbound flood control per user, USER_RATE_LIMIT=0 disables it
+USER_RATE_LIMIT = float(os.getenv('USER_RATE_LIMIT', 1))  # updates per second
+USER_RATE_BURST = float(os.getenv('USER_RATE_BURST', 5))
+USER_DUPLICATE_WINDOW = float(os.getenv('USER_DUPLICATE_WINDOW', 2))  # identical messages within it are merged into the first
+# Load shedding kicks in past either threshold, 0 disables a check
+OVERLOAD_QUEUE_DEPTH = int(os.getenv('OVERLOAD_QUEUE_DEPTH', DISPATCH_QUEUE_SIZE))
+OVERLOAD_P99 = float(os.getenv('OVERLOAD_P99', 2))  # seconds, over the last 500 updates
+
+# Instrumentation, METRICS_PORT=0 disables the /metrics listener
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9102))
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', 300))
+# Sample the stacks of updates running longer than this many seconds, 0 disables the profiler
+SLOW_UPDATE_PROFILE_THRESHOLD = float(os.getenv('SLOW_UPDATE_PROFILE_THRESHOLD', 0))
+
+# The bot is created by create_app(), importing this module has no side effects
+bot = None
+
+# Setup scheduler, started by create_app()
+# Interval jobs don't depend on the timezone, but APScheduler 3.6 only accepts pytz zones
+# and recent tzlocal versions no longer return one
+scheduler = BackgroundScheduler(timezone=pytz.utc)
 
 # Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=os.getenv('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger(__name__)
 
+class Metrics:
+    """Process-wide counters, gauges and histograms in the Prometheus text format.
+
+    Updating a metric takes one lock and a bisect, cheap enough for every SQL
+    statement and Bot API call.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix: str = 'lantern'):
+        self.prefix = prefix
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self.last_summary = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Per bucket counts, then sum and count
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0, 0]
+            histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name: str, read) -> None:
+        """Register a callable read whenever metrics are rendered."""
+        self.gauges[name] = read
+
+    @staticmethod
+    def format_labels(labels, **extra) -> str:
+        labels = list(labels) + list(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+    def render(self) -> str:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f'{self.prefix}_{name}{self.format_labels(labels)} {value:g}')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'{self.prefix}_{name} {read():g}')
+        for (name, labels), histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append(f'{self.prefix}_{name}_bucket{self.format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{self.prefix}_{name}_sum{self.format_labels(labels)} {histogram[-2]:g}')
+            lines.append(f'{self.prefix}_{name}_count{self.format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def totals(self) -> dict:
+        """Counter values and histogram sums and counts, summed over labels unless grouped by handler or method."""
+        totals = defaultdict(float)
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                totals[name] += value
+                if name == 'bot_api_errors_total':
+                    totals[f'{name}:{dict(labels)["error"]}'] += value
+            for (name, labels), histogram in self.histograms.items():
+                group = dict(labels).get('handler') or dict(labels).get('method')
+                for suffix, value in (('sum', histogram[-2]), ('count', histogram[-1])):
+                    totals[f'{name}_{suffix}'] += value
+                    if group:
+                        totals[f'{name}_{suffix}:{group}'] += value
+        return totals
+
+    def summary(self) -> str:
+        """Describe what happened since the previous summary, for the periodic log line."""
+        totals = self.totals()
+        delta = {name: value - self.last_summary.get(name, 0) for name, value in totals.items()}
+        self.last_summary = totals
+
+        def mean_ms(name, group=None):
+            suffix = f':{group}' if group else ''
+            count = delta.get(f'{name}_count{suffix}')
+            return delta[f'{name}_sum{suffix}'] / count * 1000 if count else 0.0
+
+        updates = delta.get('update_duration_seconds_count', 0)
+        per_update = lambda name: delta.get(f'{name}_count', 0) / updates if updates else 0.0
+        handlers = [name.split(':', 1)[1] for name in delta if name.startswith('handler_duration_seconds_count:') and delta[name]]
+        handlers.sort(key=lambda handler: -delta[f'handler_duration_seconds_sum:{handler}'])
+        return (
+            f'{updates:.0f} updates taking {mean_ms("update_duration_seconds"):.1f}ms, '
+            f'{per_update("sql_statement_seconds"):.1f} SQL statements ({mean_ms("sql_statement_seconds"):.1f}ms) and '
+            f'{per_update("bot_api_request_seconds"):.1f} Bot API calls ({mean_ms("bot_api_request_seconds"):.1f}ms) per update, '
+            f'{delta.get("bot_api_errors_total:RetryAfter", 0):.0f} RetryAfter, {delta.get("bot_api_errors_total:BadRequest", 0):.0f} BadRequest, '
+            + ', '.join(f'{name} {read():g}' for name, read in sorted(self.gauges.items()))
+            + '; busiest handlers: '
+            + ', '.join(f'{handler} x{delta[f"handler_duration_seconds_count:{handler}"]:.0f} {mean_ms("handler_duration_seconds", handler):.1f}ms' for handler in handlers[:5])
+        )
+
+metrics = Metrics()
+
+class SlowUpdateProfiler(threading.Thread):
+    """Samples the stacks of updates running longer than threshold seconds.
+
+    Only threads past the threshold are sampled, so fast updates cost a dict insert.
+    When a sampled update finishes, its most frequent stacks are logged.
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.01):
+        super().__init__(name='slow-update-profiler', daemon=True)
+        self.threshold = threshold
+        self.interval = interval
+        # Thread ident -> [update_id, started, Counter of stacks]
+        self.active = {}
+
+    def begin(self, update) -> None:
+        if self.threshold:
+            self.active[threading.get_ident()] = [getattr(update, 'update_id', None), time.perf_counter(), Counter()]
+
+    def end(self) -> None:
+        entry = self.active.pop(threading.get_ident(), None)
+        if entry and entry[2]:
+            update_id, started, stacks = entry
+            top = '\n'.join(f'  {count * self.interval * 1000:.0f}ms {stack}' for stack, count in stacks.most_common(5))
+            logger.warning(f'Update {update_id} took {time.perf_counter() - started:.3f}s, stacks sampled after {self.threshold}s:\n{top}')
+
+    @staticmethod
+    def format_stack(frame) -> str:
+        # Our own frames, then the library frame the thread is actually in
+        stack = traceback.extract_stack(frame)
+        entries = [entry for entry in stack[:-1] if entry.filename == __file__] + stack[-1:]
+        return ' > '.join(f'{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})' for entry in entries)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            frames = None
+            for ident, (_, started, stacks) in list(self.active.items()):
+                if now - started < self.threshold:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                if ident in frames:
+                    stacks[self.format_stack(frames[ident])] += 1
+
+profiler = SlowUpdateProfiler(SLOW_UPDATE_PROFILE_THRESHOLD)
+
 # Database setup with SQLAlchemy
 Base = declarative_base()
 
@@ -48,13 +344,25 @@ class User(Base):
     wish_date = Column(DateTime, nullable=True)
     wish_claimed = Column(Boolean, default=False)
     invitees_count = Column(Integer, default=0)
+    # Denormalized over the user's invitees, kept current by bump_inviter_counters()
+    invitees_subscribed_count = Column(Integer, default=0)
+    invitees_wish_count = Column(Integer, default=0)
     username = Column(String(255), unique=True)
     wallet_address = Column(String(255), nullable=True)
     is_subscribed = Column(Boolean, default=False)
     message_id = Column(BigInteger, nullable=True)
     update_count = Column(Integer, default=0)
-
-    __table_args__ = (Index('idx_username','username'),)
+    # Set when a send fails because the user blocked the bot, broadcasts skip these users
+    blocked_bot = Column(Boolean, default=False)
+    # Bumped by every UPDATE, UserChangeFeed polls it to keep other processes' user caches current
+    updated_at = Column(DateTime, nullable=True, onupdate=func.now())
+
+    __table_args__ = (
+        Index('idx_username','username'),
+        Index('idx_users_invitees_count', 'invitees_count'),
+        Index('idx_users_wallet_address', 'wallet_address'),
+        Index('idx_users_updated', 'updated_at', 'user_id'),
+    )
 
 class Invite(Base):
     __tablename__ = 'invites'
@@ -62,25 +370,123 @@ class Invite(Base):
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey('users.user_id'))
     invitee_id = Column(BigInteger, ForeignKey('users.user_id'))
+    # Times the invitee opened the same inviter's link again after the first /start
+    repeat_count = Column(Integer, default=0)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
     user = relationship('User', foreign_keys=[user_id], backref=backref('invites', uselist=True))
     invitee = relationship('User', foreign_keys=[invitee_id], backref=backref('invited_by', uselist=True))
 
-DATABASE_URL = f"mysql+mysqlconnector://{os.getenv('MYSQL_USERNAME')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DATABASE')}?charset=utf8mb4"  
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'invitee_id', name='uq_invites_user_invitee'),
+        Index('idx_invites_invitee_user', 'invitee_id', 'user_id'),
+    )
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+
+    # ConversationHandler name, or 'user_data'
+    kind = Column(String(64), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    # JSON encoded state or user_data, NULL once the conversation ended
+    data = Column(Text, nullable=True)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('idx_conversation_states_user', 'user_id'),
+        Index('idx_conversation_states_updated', 'updated_at'),
+    )
+
+class JobCheckpoint(Base):
+    __tablename__ = 'job_checkpoints'
+
+    name = Column(String(64), primary_key=True)
+    # users.id of the last row the job finished with
+    last_id = Column(BigInteger, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    message = Column(Text, nullable=False)
+    audience = Column(String(16), default='all')
+    status = Column(Enum('running', 'done', 'cancelled'), default='running')
+    # Every recipient up to users.id last_id was handled, done_ids lists handled ids above it
+    last_id = Column(BigInteger, default=0)
+    done_ids = Column(Text, nullable=True)
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    progress_message_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    # Doubles as the lease of the process delivering it, see resume_broadcasts()
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class StatRollup(Base):
+    __tablename__ = 'stat_rollups'
+
+    name = Column(String(32), primary_key=True)
+    # 'all' for campaign totals, otherwise the hour as YYYY-MM-DDTHH
+    period = Column(String(13), primary_key=True)
+    value = Column(BigInteger, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+DATABASE_URL = os.getenv('DATABASE_URL') or f"mysql+mysqlconnector://{os.getenv('MYSQL_USERNAME')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DATABASE')}?charset=utf8mb4"
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
 
 Session = sessionmaker(bind=engine)
 
 # Admins list
-admins = [int(admin_id) for admin_id in os.getenv('ADMIN_IDS').split(',')]
+admins = [int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id]
+
+# Per-thread unit of work, see update_scope()
+db_context = threading.local()
+
+@event.listens_for(engine, 'checkout')
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    db_context.checkouts = getattr(db_context, 'checkouts', 0) + 1
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    db_context.statements = getattr(db_context, 'statements', 0) + 1
+    conn.info['statement_started'] = time.perf_counter()
+
+@event.listens_for(engine, 'after_cursor_execute')
+def time_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop('statement_started')
+    db_context.sql_seconds = getattr(db_context, 'sql_seconds', 0.0) + elapsed
+    metrics.observe('sql_statement_seconds', elapsed)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_loaded_users(session, previous_transaction):
+    # Loaded rows and changes waiting for the user cache are void after a rollback
+    for key in ('users', 'stale_users', 'credited_inviters', 'stat_deltas'):
+        session.info.pop(key, None)
 
 @contextmanager
 def session_scope():
-    """Provide a transactional scope around a series of operations."""
+    """Provide a transactional scope around a series of operations.
+
+    Scopes opened while another one is active on the same thread reuse its session,
+    so helpers called from a handler share the update's unit of work.
+    """
+    session = getattr(db_context, 'session', None)
+    if session is not None:
+        yield session
+        return
     session = Session()
+    db_context.session = session
     try:
         yield session
         session.commit()
@@ -88,25 +494,899 @@ def session_scope():
         session.rollback()
         raise
     finally:
+        db_context.session = None
         session.close()
 
+@contextmanager
+def update_scope(update=None):
+    """Unit of work for one update, recording the database work it caused."""
+    db_context.checkouts = 0
+    db_context.statements = 0
+    db_context.sql_seconds = 0.0
+    started = time.perf_counter()
+    profiler.begin(update)
+    try:
+        with session_scope():
+            yield
+    finally:
+        profiler.end()
+        elapsed = time.perf_counter() - started
+        metrics.observe('update_duration_seconds', elapsed)
+        load_shedder.observe(elapsed)
+        metrics.observe('update_sql_seconds', db_context.sql_seconds)
+    logger.debug(f'Update handled in {elapsed:.3f}s with {db_context.checkouts} connection checkouts and {db_context.statements} statements taking {db_context.sql_seconds:.3f}s')
+
+def get_user(session, user_id):
+    """Load a User by Telegram user_id, querying at most once per session."""
+    users = session.info.setdefault('users', {})
+    user_id = int(user_id)
+    if user_id not in users:
+        users[user_id] = session.query(User).filter_by(user_id=user_id).first()
+    return users[user_id]
+
+def invitee_stats_subquery(inviters=None):
+    """Invitees, subscribed invitees and invitees with a wish per inviter, in one aggregate join over invites.
+
+    Limited to the given inviter IDs when passed, which reads only their range of uq_invites_user_invitee.
+    """
+    invitee = aliased(User)
+    query = select(
+        Invite.user_id.label('user_id'),
+        func.count(Invite.id).label('invitees'),
+        func.sum(case((invitee.is_subscribed == True, 1), else_=0)).label('subscribed'),
+        func.sum(case((invitee.wish != None, 1), else_=0)).label('wishes'),
+    ).join(invitee, invitee.user_id == Invite.invitee_id).group_by(Invite.user_id)
+    if inviters is not None:
+        query = query.where(Invite.user_id.in_(inviters))
+    return query.subquery()
+
+# Schema maintenance
+def reconcile_invitee_counters(fix: bool = False) -> int:
+    """Compare the denormalized invitee counters against one aggregate join over invites.
+
+    Returns the number of users whose counters drifted, correcting them when fix is set.
+    """
+    with session_scope() as session:
+        actual = invitee_stats_subquery()
+        invitees = func.coalesce(actual.c.invitees, 0)
+        subscribed = func.coalesce(actual.c.subscribed, 0)
+        wishes = func.coalesce(actual.c.wishes, 0)
+        drifted = session.query(User.id, User.user_id, invitees, subscribed, wishes).outerjoin(actual, actual.c.user_id == User.user_id).filter(or_(
+            func.coalesce(User.invitees_count, 0) != invitees,
+            func.coalesce(User.invitees_subscribed_count, 0) != subscribed,
+            func.coalesce(User.invitees_wish_count, 0) != wishes,
+        )).all()
+        for _, user_id, invitees_count, subscribed_count, wish_count in drifted:
+            logger.warning(f'Invitee counters of {user_id} drifted, actual invitees={invitees_count} subscribed={subscribed_count} wishes={wish_count}')
+        if fix and drifted:
+            session.bulk_update_mappings(User, [
+                {'id': id, 'invitees_count': invitees_count, 'invitees_subscribed_count': subscribed_count, 'invitees_wish_count': wish_count}
+                for id, _, invitees_count, subscribed_count, wish_count in drifted
+            ])
+        return len(drifted)
+
+def migrate_schema() -> None:
+    """Bring live tables up to date with the models, create_all() never alters existing tables.
+
+    Indexes are added with online DDL so the bot can keep serving during the migration.
+    """
+    inspector = inspect(engine)
+    user_columns = {column['name'] for column in inspector.get_columns('users')}
+    invite_columns = {column['name'] for column in inspector.get_columns('invites')}
+    user_indexes = {index['name'] for index in inspector.get_indexes('users')}
+    invite_indexes = {index['name'] for index in inspector.get_indexes('invites')}
+    invite_indexes |= {constraint['name'] for constraint in inspector.get_unique_constraints('invites')}
+    conversation_state_indexes = {index['name'] for index in inspector.get_indexes('conversation_states')}
+    backfill = False
+    with engine.begin() as connection:
+        for name in ('invitees_subscribed_count', 'invitees_wish_count'):
+            if name not in user_columns:
+                connection.execute(text(f'ALTER TABLE users ADD COLUMN {name} INTEGER DEFAULT 0'))
+                backfill = True
+        if 'blocked_bot' not in user_columns:
+            connection.execute(text('ALTER TABLE users ADD COLUMN blocked_bot BOOLEAN DEFAULT FALSE'))
+        if 'updated_at' not in user_columns:
+            # Nullable without a default, so the column is added instantly
+            connection.execute(text('ALTER TABLE users ADD COLUMN updated_at DATETIME NULL'))
+        if 'idx_users_updated' not in user_indexes:
+            connection.execute(text('ALTER TABLE users ADD INDEX idx_users_updated (updated_at, user_id), ALGORITHM=INPLACE, LOCK=NONE'))
+        if 'idx_users_invitees_count' not in user_indexes:
+            connection.execute(text('ALTER TABLE users ADD INDEX idx_users_invitees_count (invitees_count), ALGORITHM=INPLACE, LOCK=NONE'))
+        if 'idx_users_wallet_address' not in user_indexes:
+            connection.execute(text('ALTER TABLE users ADD INDEX idx_users_wallet_address (wallet_address), ALGORITHM=INPLACE, LOCK=NONE'))
+        if 'repeat_count' not in invite_columns:
+            connection.execute(text('ALTER TABLE invites ADD COLUMN repeat_count INTEGER DEFAULT 0'))
+        if 'uq_invites_user_invitee' not in invite_indexes:
+            # Concurrent /starts may have recorded the same invite twice, keep the oldest row
+            connection.execute(text('DELETE newer FROM invites newer JOIN invites older ON newer.user_id = older.user_id AND newer.invitee_id = older.invitee_id AND newer.id > older.id'))
+            connection.execute(text('ALTER TABLE invites ADD UNIQUE INDEX uq_invites_user_invitee (user_id, invitee_id), ALGORITHM=INPLACE, LOCK=NONE'))
+            backfill = True
+        if 'idx_invites_invitee_user' not in invite_indexes:
+            connection.execute(text('ALTER TABLE invites ADD INDEX idx_invites_invitee_user (invitee_id, user_id), ALGORITHM=INPLACE, LOCK=NONE'))
+        if 'idx_conversation_states_updated' not in conversation_state_indexes:
+            connection.execute(text('ALTER TABLE conversation_states ADD INDEX idx_conversation_states_updated (updated_at), ALGORITHM=INPLACE, LOCK=NONE'))
+    if backfill:
+        # One-off backfill of new counters, or of counts inflated by duplicate invites
+        reconcile_invitee_counters(fix=True)
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire ttl seconds after being set.
+
+    Every write or pop bumps generation and records it against the key. A reader that
+    loaded a value from the database passes the generation it saw before loading, and
+    the value is dropped only if that key was written or popped in the meantime. The
+    newest maxsize of those records are kept, a fill older than the evicted ones is dropped.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        # key -> generation of its last write or pop
+        self._written = OrderedDict()
+        self._oldest_written = 0
+        self._lock = threading.Lock()
+
+    def _record_write(self, key) -> None:
+        self.generation += 1
+        self._written[key] = self.generation
+        self._written.move_to_end(key)
+        while len(self._written) > self.maxsize:
+            self._oldest_written = self._written.popitem(last=False)[1]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation: int = None) -> None:
+        with self._lock:
+            if generation is None:
+                self._record_write(key)
+            elif generation < self._oldest_written or self._written.get(key, 0) > generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._record_write(key)
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._oldest_written = self.generation
+            self._written.clear()
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_SIZE)
+
+class BotMetadata:
+    """Bot identity and the configured chats, resolved once and cached on disk.
+
+    With a cache file from a previous run the bot serves immediately and refreshes
+    in the background; otherwise start-up waits for one concurrent resolution.
+    """
+    CHATS = ('admin_group', 'group', 'channel')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.me = None
+        self.admin_group = None
+        self.group = None
+        self.channel = None
+
+    @staticmethod
+    def chat_ids() -> dict:
+        return {'admin_group': os.getenv('ADMIN_GROUP_ID'), 'group': os.getenv('GROUP_ID'), 'channel': os.getenv('CHANNEL_NAME')}
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        # A cache written for another bot or other chats is useless
+        if data.get('token_id') != os.getenv('BOT_TOKEN', '').split(':')[0] or data.get('chat_ids') != self.chat_ids():
+            return False
+        self.me = TelegramUser.de_json(data['me'], bot)
+        for name in self.CHATS:
+            setattr(self, name, Chat.de_json(data[name], bot))
+        # Dispatcher.start reads bot.id, which would otherwise call getMe
+        bot._bot = self.me
+        return True
+
+    def save(self) -> None:
+        data = {
+            'token_id': os.getenv('BOT_TOKEN', '').split(':')[0],
+            'chat_ids': self.chat_ids(),
+            'me': self.me.to_dict(),
+            **{name: getattr(self, name).to_dict() for name in self.CHATS},
+        }
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self) -> None:
+        """Resolve getMe and the chats concurrently, then persist them."""
+        chat_ids = self.chat_ids()
+        with ThreadPoolExecutor(max_workers=1 + len(self.CHATS)) as executor:
+            me = executor.submit(bot.get_me)
+            chats = {name: executor.submit(bot.get_chat, chat_id=chat_ids[name]) for name in self.CHATS}
+            self.me = bot._bot = me.result()
+            for name, chat in chats.items():
+                setattr(self, name, chat.result())
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning(f'Could not write {self.path}: {e}')
+
+    def refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f'Metadata refresh failed, keeping cached values: {e}')
+
+    def resolve(self, retries: int = 5) -> None:
+        if self.load():
+            logger.info(f'Loaded bot metadata from {self.path}')
+            scheduler.add_job(self.refresh_in_background)
+            return
+        for attempt in range(retries):
+            try:
+                self.refresh()
+                return
+            except NetworkError as e:
+                if attempt == retries - 1:
+                    raise
+                logger.warning(f'Resolving bot metadata failed, retrying: {e}')
+                time.sleep(2 ** attempt)
+
+bot_metadata = BotMetadata(METADATA_CACHE_FILE)
+
+# Read-through cache of immutable user rows. Rows flushed by the ORM or changed by bulk
+# UPDATEs are dropped from the cache when their transaction commits, the next read
+# reloads them. Publishing the written rows instead could let an older writer's
+# snapshot, committed last, overwrite a newer one. Rows written by other processes
+# are dropped by UserChangeFeed within USER_CACHE_SYNC_INTERVAL.
+UserSnapshot = namedtuple('UserSnapshot', [column.key for column in User.__table__.columns])
+user_cache = TTLCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+@event.listens_for(Session, 'after_begin')
+def note_cache_generation(session, transaction, connection):
+    # Whatever this transaction reads is at least as new as the user cache is now
+    session.info['user_cache_generation'] = user_cache.generation
+
+def snapshot_user(user):
+    return UserSnapshot(*(getattr(user, name) for name in UserSnapshot._fields))
+
+def mark_users_stale(session, user_ids) -> None:
+    """Drop users from the cache once the transaction writing them commits."""
+    session.info.setdefault('stale_users', set()).update(user_ids)
+
+@event.listens_for(Session, 'after_flush')
+def collect_written_users(session, flush_context):
+    user_ids = [instance.user_id for instance in itertools.chain(session.new, session.dirty, session.deleted) if isinstance(instance, User) and instance.user_id is not None]
+    if user_ids:
+        mark_users_stale(session, user_ids)
+
+@event.listens_for(Session, 'after_commit')
+def drop_stale_users(session):
+    stale_users = session.info.pop('stale_users', ())
+    for user_id in stale_users:
+        user_cache.pop(user_id)
+    if stale_users:
+        draw_pool.mark_stale(stale_users)
+
+def get_user_snapshot(user_id):
+    """Read-only view of a user row, served from the user cache when possible."""
+    user_id = int(user_id)
+    session = getattr(db_context, 'session', None)
+    if session is not None and session.info.get('users', {}).get(user_id) is not None:
+        # The update already holds the row, possibly with uncommitted changes
+        return snapshot_user(session.info['users'][user_id])
+    if USER_CACHE_ENABLED:
+        snapshot = user_cache.get(user_id)
+        if snapshot is not None:
+            return snapshot
+    with session_scope() as session:
+        user = get_user(session, user_id)
+        snapshot = snapshot_user(user) if user else None
+        # The update's shared session may have started, and taken its snapshot, well before this call
+        generation = session.info.get('user_cache_generation', 0)
+    if snapshot is not None and USER_CACHE_ENABLED:
+        user_cache.set(user_id, snapshot, generation=generation)
+    return snapshot
+
+class UserChangeFeed:
+    """Drops users changed by any process from the user cache, polling users.updated_at."""
+
+    def __init__(self):
+        self.polled_at = None
+
+    def poll(self) -> None:
+        with session_scope() as session:
+            if self.polled_at is None:
+                self.polled_at = session.query(func.now()).scalar()
+                return
+            # updated_at has second resolution and commits trail it, overlap the last window
+            rows = session.query(User.user_id, User.updated_at).filter(User.updated_at >= self.polled_at - timedelta(seconds=2)).all()
+        for user_id, updated_at in rows:
+            self.polled_at = max(self.polled_at, updated_at)
+            user_cache.pop(user_id)
+
+user_changes = UserChangeFeed()
+
+class InviteRanking:
+    """In-memory ranking of inviters by invitees_count.
+
+    Only users with at least one invitee are held, grouped by count, so top-K and a
+    user's rank cost O(distinct counts). Loaded from idx_users_invitees_count and
+    credited in place when an invite commits, reload() corrects any drift.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.by_count = defaultdict(set)
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def reload(self) -> None:
+        with session_scope() as session:
+            rows = session.query(User.user_id, User.invitees_count).filter(User.invitees_count > 0, User.user_id != None).all()
+        counts = dict(rows)
+        by_count = defaultdict(set)
+        for user_id, count in counts.items():
+            by_count[count].add(user_id)
+        with self.lock:
+            self.counts, self.by_count, self.loaded = counts, by_count, True
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            self.reload()
+
+    def credit(self, user_id: int) -> None:
+        with self.lock:
+            if not self.loaded:
+                return
+            count = self.counts.get(user_id, 0)
+            if count:
+                self.by_count[count].discard(user_id)
+                if not self.by_count[count]:
+                    del self.by_count[count]
+            self.counts[user_id] = count + 1
+            self.by_count[count + 1].add(user_id)
+
+    def top(self, k: int) -> list:
+        """[(rank, user_id, count)] of the k best inviters, tied users share a rank."""
+        self.ensure_loaded()
+        leaders = []
+        with self.lock:
+            for count in sorted(self.by_count, reverse=True):
+                rank = len(leaders) + 1
+                leaders += [(rank, user_id, count) for user_id in sorted(self.by_count[count])]
+                if len(leaders) >= k:
+                    break
+        return leaders[:k]
+
+    def rank(self, user_id: int):
+        """One plus the number of users with more invitees, None without any invitee."""
+        self.ensure_loaded()
+        with self.lock:
+            count = self.counts.get(int(user_id))
+            if not count:
+                return None
+            return 1 + sum(len(user_ids) for other, user_ids in self.by_count.items() if other > count)
+
+invite_ranking = InviteRanking()
+
+@event.listens_for(Session, 'after_commit')
+def credit_inviters(session):
+    for inviter_id in session.info.pop('credited_inviters', ()):
+        invite_ranking.credit(inviter_id)
+
+# Campaign funnel counters
+STAT_TOTALS = ('users', 'subscribed', 'wallets', 'wishes', 'claimed', 'invites')
+STAT_HOURLY = ('users', 'wishes', 'invites')
+STAT_TOTAL = 'all'
+
+def stat_hour(at: datetime) -> str:
+    return f'{at:%Y-%m-%dT%H}'
+
+def count_stat(session, name: str, delta: int = 1, at: datetime = None) -> None:
+    """Add delta to a campaign counter, and to the hour of at, once the caller's transaction commits."""
+    if not delta:
+        return
+    deltas = session.info.setdefault('stat_deltas', Counter())
+    deltas[name, STAT_TOTAL] += delta
+    if name in STAT_HOURLY:
+        deltas[name, stat_hour(at or datetime.now())] += delta
+
+class CampaignStats:
+    """Rollup counters behind /stats.
+
+    Write paths add committed deltas in memory in O(1), flush() folds them into
+    stat_rollups with one upsert and reconcile() recounts the base tables now and then
+    to correct drift, so reading the stats never scans users or invites.
+
+    Commits carrying deltas pass a gate that reconcile() closes for the moment it opens
+    its snapshot. Every delta published before then is in the recount and dropped,
+    every later one is not and is kept.
+    """
+
+    def __init__(self):
+        self.pending = Counter()
+        self.lock = threading.Lock()
+        # Serializes flush() and reconcile(), a flush landing after a recount would count twice
+        self.write_lock = threading.Lock()
+        self.gate = threading.Condition()
+        self.committing = 0
+        self.snapshotting = False
+
+    def add(self, deltas: Counter) -> None:
+        with self.lock:
+            self.pending.update(deltas)
+
+    def enter_commit(self) -> None:
+        with self.gate:
+            while self.snapshotting:
+                self.gate.wait()
+            self.committing += 1
+
+    def leave_commit(self) -> None:
+        with self.gate:
+            self.committing -= 1
+            self.gate.notify_all()
+
+    def flush(self) -> None:
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, Counter()
+            rows = [{'name': name, 'period': period, 'value': value} for (name, period), value in pending.items() if value]
+            if not rows:
+                return
+            try:
+                with session_scope() as session:
+                    statement = mysql_insert(StatRollup).values(rows)
+                    session.execute(statement.on_duplicate_key_update(value=StatRollup.value + statement.inserted.value))
+            except Exception as e:
+                logger.exception(e)
+                self.add(pending)
+
+    def reconcile(self) -> None:
+        """Overwrite the totals and the hourly invite counts with fresh counts of the base tables."""
+        with self.write_lock, session_scope() as session:
+            started = time.perf_counter()
+            with self.gate:
+                self.snapshotting = True
+                try:
+                    while self.committing:
+                        self.gate.wait()
+                    # InnoDB's REPEATABLE READ fixes the snapshot of every table at the first read
+                    session.execute(select(StatRollup.name).limit(1)).all()
+                    with self.lock:
+                        self.pending = Counter({key: value for key, value in self.pending.items() if not self.recounted(*key)})
+                finally:
+                    self.snapshotting = False
+                    self.gate.notify_all()
+            users, subscribed, wallets, wishes, claimed = session.query(
+                func.count(User.id),
+                func.sum(case((User.is_subscribed == True, 1), else_=0)),
+                func.sum(case((User.wallet_address != None, 1), else_=0)),
+                func.sum(case((User.wish != None, 1), else_=0)),
+                func.sum(case((User.wish_claimed == True, 1), else_=0)),
+            ).one()
+            invites = session.query(func.count(Invite.id)).scalar()
+            totals = {'users': users, 'subscribed': subscribed, 'wallets': wallets, 'wishes': wishes, 'claimed': claimed, 'invites': invites}
+            rows = [{'name': name, 'period': STAT_TOTAL, 'value': int(value or 0)} for name, value in totals.items()]
+            # Only invites keep their creation time, the other hourly counters are as recorded
+            hour = [extract(part, Invite.created_at) for part in ('year', 'month', 'day', 'hour')]
+            for year, month, day, hour_of_day, count in session.query(*hour, func.count(Invite.id)).filter(Invite.created_at != None).group_by(*hour):
+                rows.append({'name': 'invites', 'period': stat_hour(datetime(int(year), int(month), int(day), int(hour_of_day))), 'value': count})
+            statement = mysql_insert(StatRollup).values(rows)
+            session.execute(statement.on_duplicate_key_update(value=statement.inserted.value))
+        logger.info(f'Reconciled campaign stats in {time.perf_counter() - started:.2f}s: {totals}')
+
+    @staticmethod
+    def recounted(name: str, period: str) -> bool:
+        return period == STAT_TOTAL or name == 'invites'
+
+    def read(self, hours: int) -> tuple:
+        """(totals, {name: [(hour, value)]} for the last hours), including deltas not flushed yet."""
+        now = datetime.now()
+        periods = [stat_hour(now - timedelta(hours=i)) for i in reversed(range(hours))]
+        with session_scope() as session:
+            values = Counter({(name, period): value for name, period, value in session.query(StatRollup.name, StatRollup.period, StatRollup.value).filter(StatRollup.period.in_([STAT_TOTAL] + periods))})
+        with self.lock:
+            values.update(self.pending)
+        totals = {name: values[name, STAT_TOTAL] for name in STAT_TOTALS}
+        hourly = {name: [(period, values[name, period]) for period in periods] for name in STAT_HOURLY}
+        return totals, hourly
+
+campaign_stats = CampaignStats()
+
+@event.listens_for(Session, 'before_commit')
+def enter_stat_commit(session):
+    if session.info.get('stat_deltas') and not session.info.get('stat_commit'):
+        campaign_stats.enter_commit()
+        session.info['stat_commit'] = True
+
+@event.listens_for(Session, 'after_commit')
+def publish_stat_deltas(session):
+    deltas = session.info.pop('stat_deltas', None)
+    if deltas:
+        campaign_stats.add(deltas)
+
+@event.listens_for(Session, 'after_transaction_end')
+def leave_stat_commit(session, transaction):
+    # After publishing on commit, and on a failed commit too
+    if transaction.parent is None and session.info.pop('stat_commit', False):
+        campaign_stats.leave_commit()
+
+# Outbound message queue
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BROADCAST = 2
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding at most capacity tokens."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.not_before = 0.0
+
+    def available_at(self, now: float) -> float:
+        """Earliest time a token can be taken, equal to now if one is available."""
+        if now < self.not_before:
+            return self.not_before
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return now
+        self.not_before = now + (1 - self.tokens) / self.rate
+        return self.not_before
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, until: float) -> None:
+        self.not_before = max(self.not_before, until)
+
+class OutboundJob:
+    __slots__ = ('chat_id', 'method', 'kwargs', 'priority', 'seq', 'future', 'attempts')
+
+    def __init__(self, chat_id, method, kwargs, priority, seq):
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.attempts = 0
+
+class OutboxShard(threading.Thread):
+    """Sender thread owning a subset of chats and their per-chat token buckets.
+
+    Jobs of one chat always land on the same shard and leave it in submission order.
+    A job whose chat is out of tokens is parked until its bucket refills, so a slow
+    group chat never holds up replies to other chats. The global token goes to the
+    most urgent job across shards, see Outbox.take_global_token.
+    """
+
+    def __init__(self, outbox, name: str):
+        super().__init__(name=name, daemon=True)
+        self.outbox = outbox
+        self.ready = []    # heap of (priority, seq, job)
+        self.delayed = []  # heap of (ready_at, seq, job)
+        self.buckets = {}
+        self.in_flight = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+
+    def put(self, job: OutboundJob) -> None:
+        with self.condition:
+            heapq.heappush(self.ready, (job.priority, job.seq, job))
+            self.condition.notify()
+
+    def retry(self, job: OutboundJob, delay: float) -> None:
+        with self.condition:
+            until = time.monotonic() + delay
+            self.chat_bucket(job.chat_id).pause(until)
+            heapq.heappush(self.delayed, (until, job.seq, job))
+            self.condition.notify()
+
+    def pending(self) -> int:
+        with self.condition:
+            return len(self.ready) + len(self.delayed) + self.in_flight
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(PRIVATE_SEND_RATE, capacity=3)
+            else:
+                bucket = TokenBucket(GROUP_SEND_RATE, capacity=5)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def prune_buckets(self, now: float) -> None:
+        # Full buckets carry no state worth keeping
+        for chat_id, bucket in list(self.buckets.items()):
+            if bucket.not_before < now and bucket.available_at(now) == now and bucket.tokens >= bucket.capacity:
+                del self.buckets[chat_id]
+
+    def next_job(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (job.priority, job.seq, job))
+                if self.ready:
+                    _, _, job = heapq.heappop(self.ready)
+                    bucket = self.chat_bucket(job.chat_id)
+                    ready_at = bucket.available_at(now)
+                    if ready_at > now:
+                        heapq.heappush(self.delayed, (ready_at, job.seq, job))
+                        continue
+                    wait = self.outbox.take_global_token(self, job)
+                    if wait:
+                        heapq.heappush(self.ready, (job.priority, job.seq, job))
+                        self.condition.wait(wait)
+                        continue
+                    bucket.consume()
+                    self.in_flight += 1
+                    return job
+                self.outbox.withdraw(self)
+                if self.stopping and not self.delayed:
+                    return None
+                if len(self.buckets) > 1000:
+                    self.prune_buckets(now)
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def run(self) -> None:
+        while True:
+            job = self.next_job()
+            if job is None:
+                break
+            try:
+                self.outbox.deliver(self, job)
+            finally:
+                with self.condition:
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+class Outbox:
+    """Central rate-limited queue for every outbound Bot API call.
+
+    Handlers submit sends and get a Future back instead of blocking on Telegram.
+    Calls are paced by a global token bucket and per-chat buckets, retried after the
+    delay Telegram asks for on RetryAfter, and user-facing replies go out before
+    admin-group notifications. Global tokens are granted in priority order across
+    shards. A flood wait pauses the chat's bucket, and the global one too when
+    several chats hit one at once.
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS):
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, capacity=GLOBAL_SEND_RATE)
+        self.global_lock = threading.Lock()
+        self.global_waiters = {}  # shard -> (priority, seq) of the job it wants to send next
+        self.flood_waits = deque()  # (time, chat_id) of recent RetryAfter answers
+        self.seq = itertools.count()
+        self.shards = [OutboxShard(self, name=f'outbox-{i}') for i in range(workers)]
+
+    def start(self) -> None:
+        for shard in self.shards:
+            shard.start()
+
+    def submit(self, chat_id, method, priority: int = PRIORITY_USER, **kwargs) -> Future:
+        job = OutboundJob(chat_id, method, kwargs, priority, next(self.seq))
+        self.shards[hash(chat_id) % len(self.shards)].put(job)
+        return job.future
+
+    def send_message(self, chat_id, text: str, priority: int = PRIORITY_USER, **kwargs) -> Future:
+        return self.submit(chat_id, bot.send_message, priority, text=text, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id: int, text: str, priority: int = PRIORITY_ADMIN, **kwargs) -> Future:
+        return self.submit(chat_id, bot.edit_message_text, priority, message_id=message_id, text=text, **kwargs)
+
+    def answer_callback_query(self, chat_id, callback_query_id: str, priority: int = PRIORITY_ADMIN, **kwargs) -> Future:
+        # chat_id only picks the shard and its rate limit, the Bot API call doesn't take one
+        return self.submit(chat_id, lambda chat_id, **kwargs: bot.answer_callback_query(**kwargs), priority, callback_query_id=callback_query_id, **kwargs)
+
+    def pending(self) -> int:
+        return sum(shard.pending() for shard in self.shards)
+
+    def take_global_token(self, shard: OutboxShard, job: OutboundJob) -> float:
+        """Take a global token for job, or return how long to wait before asking again.
+
+        Only the most urgent job across all shards may take one, so a shard busy with a
+        broadcast never spends a token another shard needs for a user reply.
+        """
+        with self.global_lock:
+            self.global_waiters[shard] = (job.priority, job.seq)
+            if min(self.global_waiters.values()) != (job.priority, job.seq):
+                return 1 / GLOBAL_SEND_RATE
+            now = time.monotonic()
+            ready_at = self.global_bucket.available_at(now)
+            if ready_at > now:
+                return ready_at - now
+            self.global_bucket.consume()
+            del self.global_waiters[shard]
+            return 0
+
+    def withdraw(self, shard: OutboxShard) -> None:
+        with self.global_lock:
+            self.global_waiters.pop(shard, None)
+
+    def record_flood_wait(self, chat_id, delay: float) -> None:
+        """Pause the global bucket as well when flood waits come from several chats at once.
+
+        A single chat's flood wait, like a busy admin group's, only holds back that chat.
+        """
+        with self.global_lock:
+            now = time.monotonic()
+            self.flood_waits.append((now, chat_id))
+            while self.flood_waits[0][0] < now - GLOBAL_FLOOD_WINDOW:
+                self.flood_waits.popleft()
+            if len({flooded for _, flooded in self.flood_waits}) >= GLOBAL_FLOOD_CHATS:
+                logger.warning(f'Flood limit across {GLOBAL_FLOOD_CHATS} chats, pausing all sends for {delay}s')
+                self.global_bucket.pause(now + delay)
+
+    def deliver(self, shard: OutboxShard, job: OutboundJob) -> None:
+        try:
+            result = job.method(chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as e:
+            job.attempts += 1
+            metrics.inc('outbox_flood_wait_seconds_total', e.retry_after)
+            self.record_flood_wait(job.chat_id, e.retry_after)
+            if job.attempts <= SEND_MAX_RETRIES:
+                logger.warning(f'Flood limit for chat {job.chat_id}, retrying in {e.retry_after}s')
+                shard.retry(job, e.retry_after)
+                return
+            logger.error(f'Giving up on chat {job.chat_id} after {job.attempts} attempts')
+            job.future.set_exception(e)
+        except BadRequest as e:
+            if 'Message is not modified' in str(e):
+                job.future.set_result(None)
+                return
+            logger.warning(f'Bad request for chat {job.chat_id}: {e}')
+            job.future.set_exception(e)
+        except Unauthorized as e:
+            # The user blocked the bot, the caller decides what to do about it
+            logger.info(f'Unauthorized for chat {job.chat_id}: {e}')
+            job.future.set_exception(e)
+        except NetworkError as e:
+            job.attempts += 1
+            if job.attempts <= SEND_MAX_RETRIES:
+                shard.retry(job, 2 ** job.attempts)
+                return
+            logger.exception(e)
+            job.future.set_exception(e)
+        except Exception as e:
+            logger.exception(e)
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+
+    def stop(self, timeout: float = 30) -> None:
+        """Deliver everything still queued, waiting at most timeout seconds."""
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            shard.stop()
+        for shard in self.shards:
+            if shard.is_alive():
+                shard.join(max(0, deadline - time.monotonic()))
+        if self.pending():
+            logger.warning(f'Outbox stopped with {self.pending()} sends still pending')
+
+outbox = Outbox()
+
+def reply(update: Update, text: str, **kwargs) -> Future:
+    """Queue a message to the chat the update came from."""
+    return outbox.send_message(update.effective_chat.id, text, **kwargs)
+
+def log_delivery(chat_id):
+    def callback(future: Future) -> None:
+        if not future.exception():
+            logger.info(f"Message sent to {chat_id}: {future.result()}")
+    return callback
+
 # Database helper functions
+def bump_inviter_counters(session, invitee_id, subscribed: int = 0, wishes: int = 0) -> None:
+    """Adjust the invitee counters of everyone who invited invitee_id, in the caller's transaction."""
+    inviter_ids = [inviter_id for inviter_id, in session.query(Invite.user_id).filter_by(invitee_id=invitee_id)]
+    if not inviter_ids:
+        return
+    mark_users_stale(session, inviter_ids)
+    session.query(User).filter(User.user_id.in_(inviter_ids)).update({
+        User.invitees_subscribed_count: User.invitees_subscribed_count + subscribed,
+        User.invitees_wish_count: User.invitees_wish_count + wishes,
+    }, synchronize_session=False)
+
+def record_invite(session, inviter_id, invitee_id, invitee_subscribed: bool, invitee_has_wish: bool) -> bool:
+    """Record an invite with one upsert and credit the inviter only if the row is new.
+
+    Runs in the caller's transaction. The unique key on (user_id, invitee_id) makes
+    concurrent /starts with the same link count once.
+    """
+    # The process clock stamps the row and its hourly stat alike, so a recount lands in the same hour
+    created_at = datetime.now()
+    result = session.execute(
+        mysql_insert(Invite).values(user_id=inviter_id, invitee_id=invitee_id, created_at=created_at)
+        .on_duplicate_key_update(repeat_count=Invite.repeat_count + 1)
+    )
+    # Affected rows are 1 for a new invite and 2 when an existing one was updated
+    if result.rowcount != 1:
+        return False
+    mark_users_stale(session, [inviter_id])
+    session.info.setdefault('credited_inviters', []).append(int(inviter_id))
+    count_stat(session, 'invites', at=created_at)
+    session.query(User).filter_by(user_id=inviter_id).update({
+        User.invitees_count: User.invitees_count + 1,
+        User.invitees_subscribed_count: User.invitees_subscribed_count + int(invitee_subscribed),
+        User.invitees_wish_count: User.invitees_wish_count + int(invitee_has_wish),
+    }, synchronize_session=False)
+    return True
+
+def apply_subscription(session, user, is_subscribed: bool) -> None:
+    write_behind.discard_subscription(user.user_id)
+    if bool(user.is_subscribed) == is_subscribed:
+        return
+    # The loaded row may be stale, a write-behind flush can flip the same user meanwhile.
+    # Only the write that actually changes the column moves the counters.
+    changed = session.query(User).filter(User.user_id == user.user_id, or_(User.is_subscribed != is_subscribed, User.is_subscribed == None)).update({User.is_subscribed: is_subscribed}, synchronize_session=False)
+    set_committed_value(user, 'is_subscribed', is_subscribed)
+    mark_users_stale(session, [user.user_id])
+    if changed == 1:
+        bump_inviter_counters(session, user.user_id, subscribed=1 if is_subscribed else -1)
+        count_stat(session, 'subscribed', 1 if is_subscribed else -1)
+
 def add_user_to_db(user_id=None, name=None, status="Regular", username=None, is_subscribed=False):
     with session_scope() as session:
         user = None
         if user_id:
-            user = session.query(User).filter_by(user_id=user_id).first()
+            user = get_user(session, user_id)
 
         if user:
-            user.status = status
-            user.is_subscribed = is_subscribed
-            if name:
-                user.name = name
+            write_behind.assign(user, status=status, name=name or user.name, blocked_bot=False)
+            apply_subscription(session, user, is_subscribed)
             if user_id:
                 user.user_id = user_id
         else:
             user = User(user_id=user_id, name=name, status=status, username=username, is_subscribed=is_subscribed)
             session.add(user)
+            count_stat(session, 'users')
+            count_stat(session, 'subscribed', int(is_subscribed))
+            if user_id:
+                session.info.setdefault('users', {})[int(user_id)] = user
 
 def update_user_to_db(user_id=None, name=None, username=None, is_subscribed=False):
     with session_scope() as session:
@@ -117,41 +1397,91 @@ def update_user_to_db(user_id=None, name=None, username=None, is_subscribed=Fals
         if user:
             user.name = name
             user.user_id = user_id
-            user.is_subscribed = is_subscribed
+            apply_subscription(session, user, is_subscribed)
+
+# Reply markups are built once and shared by every reply, never mutate them
+USER_KEYBOARD_ROWS = ((KeyboardButton("🏮写下愿望"), KeyboardButton("🧧绑定钱包"), KeyboardButton("🥣我的邀请")),)
+USER_KEYBOARD = ReplyKeyboardMarkup(USER_KEYBOARD_ROWS, resize_keyboard=True, is_persistent=True)
+ADMIN_KEYBOARD = ReplyKeyboardMarkup(USER_KEYBOARD_ROWS + ((KeyboardButton("🌟实现愿望"),),), resize_keyboard=True, is_persistent=True)
 
 def get_keyboard(admin=False):
-    keyboard = [
-        [KeyboardButton("🏮写下愿望"), KeyboardButton("🧧绑定钱包"), KeyboardButton("🥣我的邀请")],
-    ]
-    if admin:
-        keyboard.append([KeyboardButton("🌟实现愿望")])
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, is_persistent=True)
+    return ADMIN_KEYBOARD if admin else USER_KEYBOARD
+
+INVITE_SIGNATURE_LENGTH = 16  # base64url characters, 96 bits
+LEGACY_INVITE_PAYLOAD = re.compile(r'(\d{1,19})_[A-Z0-9]{5}')
+
+@functools.lru_cache(maxsize=1)
+def invite_key() -> bytes:
+    return (INVITE_SECRET or hashlib.sha256(b'invite-links:' + os.getenv('BOT_TOKEN', '').encode()).hexdigest()).encode()
+
+def sign_invite(campaign: str, user_id: str) -> str:
+    digest = hmac.new(invite_key(), f'{campaign}-{user_id}'.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:INVITE_SIGNATURE_LENGTH]
+
+def invite_payload(user_id: int, campaign: str = INVITE_CAMPAIGN) -> str:
+    """Start parameter <campaign>-<user_id>-<signature>, at most 45 of the 64 allowed characters."""
+    return f'{campaign}-{user_id}-{sign_invite(campaign, user_id)}'
+
+# Unsigned links were only ever sent with a user's first wish, so only users with a wish can own one
+INVITE_LEGACY_DEADLINE = datetime.strptime(INVITE_LEGACY_UNTIL, '%Y-%m-%d') + timedelta(days=1) if INVITE_LEGACY_UNTIL else None
+legacy_inviters = frozenset()
+
+def legacy_invites_open() -> bool:
+    return INVITE_LEGACY_DEADLINE is not None and datetime.now() < INVITE_LEGACY_DEADLINE
+
+def load_legacy_inviters() -> None:
+    global legacy_inviters
+    if not legacy_invites_open():
+        return
+    with session_scope() as session:
+        legacy_inviters = frozenset(session.execute(select(User.user_id).where(User.wish != None, User.user_id != None)).scalars())
+    logger.info(f'Accepting unsigned invite links of {len(legacy_inviters)} users until {INVITE_LEGACY_UNTIL}')
+
+def parse_invite_payload(payload: str):
+    """Inviter ID of a genuine start parameter, None for anything forged, malformed or expired.
+
+    Checks the signature, or for unsigned links the set of users issued one, in memory,
+    so forged links never reach the database.
+    """
+    parts = payload.split('-', 2)
+    if len(parts) == 3:
+        campaign, user_id, signature = parts
+        if campaign in INVITE_CAMPAIGNS and user_id.isdigit() and len(user_id) < 20 and hmac.compare_digest(signature, sign_invite(campaign, user_id)):
+            return int(user_id)
+    else:
+        legacy = LEGACY_INVITE_PAYLOAD.fullmatch(payload)
+        if legacy and int(legacy.group(1)) in legacy_inviters and legacy_invites_open():
+            return int(legacy.group(1))
+    metrics.inc('invite_links_rejected_total')
+    logger.debug(f'Rejected invite payload {payload!r}')
+    return None
 
 def generate_unique_link(user_id: int) -> str:
     """Generate a unique link for each user based on their user_id"""
-    unique_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-    bot_username = bot.getMe().username
-    return f'https://t.me/{bot_username}?start={user_id}_{unique_str}'
+    bot_username = bot_metadata.me.username
+    return f'https://t.me/{bot_username}?start={invite_payload(user_id)}'
 
 def subscribe_channel_message(start_message: bool = False):
-    message = f"请先加入👉{channel_info.title}频道👈"
+    return channel_invite_message(bot_metadata.channel.title, bot_metadata.channel.invite_link, start_message)
+
+# Keyed by the channel so a metadata refresh picking up a new invite link rebuilds them
+@functools.lru_cache(maxsize=8)
+def channel_invite_message(title: str, invite_link: str, start_message: bool):
+    message = f"请先加入👉{title}频道👈"
     if start_message:
         message = f"📣恭喜，您的帐号创建成功！\n\n" + message
-    keyboard = [
-        [InlineKeyboardButton(f"{channel_info.title}", url=f"{channel_info.invite_link}")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = InlineKeyboardMarkup(((InlineKeyboardButton(f"{title}", url=f"{invite_link}"),),))
     return message, reply_markup
 
 def bind_wallet_address(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
     is_subscribed = is_user_subscribed(user_id)
     if is_subscribed:
-        update.message.reply_text('请写下你的钱包地址\n使用/cancel取消')
+        reply(update, '请写下你的钱包地址\n使用/cancel取消')
         return WALLET
     else:
         message, reply_markup = subscribe_channel_message()
-        update.message.reply_text(message, reply_markup=reply_markup)
+        reply(update, message, reply_markup=reply_markup)
         return ConversationHandler.END
 
 def receive_wallet_address(update: Update, context: CallbackContext) -> int:
@@ -159,187 +1489,553 @@ def receive_wallet_address(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
 
     with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
+        user = get_user(session, user_id)
         if user:
+            count_stat(session, 'wallets', int(not user.wallet_address))
             user.wallet_address = wallet_address
             session.commit()
-            update.message.reply_text('钱包地址已绑定。谢谢!')
+            reply(update, '钱包地址已绑定。谢谢!')
 
     return ConversationHandler.END
 
 def make_wish_come_true(update: Update, context: CallbackContext) -> None:
-    if update.effective_user.id in admins:
-        update.message.reply_text('请输入要实现愿望的用户ID')
-    else:
-        update.message.reply_text('你没有权限使用此功能')
+    if update.effective_user.id not in admins:
+        reply(update, '你没有权限使用此功能')
+        return ConversationHandler.END
+    reply(update, '请输入要实现愿望的用户ID、@用户名或钱包地址，也可以只输入开头几位搜索')
+    return WISH_COME_TRUE_READY
+
+LookupResult = namedtuple('LookupResult', 'user_id username wallet_address')
+LOOKUP_COLUMNS = {'u': User.username, 'w': User.wallet_address}
+USERNAME_PREFIX = re.compile(r'[A-Za-z0-9_]{1,32}')
+WALLET_PREFIX = re.compile(r'T[1-9A-HJ-NP-Za-km-z]{0,33}')  # TRC20 addresses are base58, 34 characters
+
+# Result pages by (column, prefix, offset), short-lived since wallets and usernames change
+lookup_cache = TTLCache(LOOKUP_CACHE_TTL, LOOKUP_CACHE_SIZE)
+
+def parse_lookup_query(query: str):
+    """('id', user_id) or (column key, prefix) for an admin's query, None when it can't be searched.
+
+    Anything shaped like a wallet address is searched as one first, usernames may look alike.
+    """
+    query = query.strip()
+    if query.isascii() and query.isdigit():
+        return 'id', int(query)
+    if len(query.lstrip('@')) < LOOKUP_MIN_PREFIX:
+        return None
+    if not query.startswith('@') and WALLET_PREFIX.fullmatch(query):
+        return 'w', query
+    query = query.lstrip('@')
+    return ('u', query) if USERNAME_PREFIX.fullmatch(query) else None
+
+def like_prefix(prefix: str) -> str:
+    # A constant pattern, unlike LIKE CONCAT(?, '%'), lets MySQL plan a range scan
+    return prefix.replace('/', '//').replace('%', '/%').replace('_', '/_') + '%'
+
+def search_users(column: str, prefix: str, offset: int = 0):
+    """A page of LookupResults whose column starts with prefix, and whether more follow.
+
+    The LIKE 'prefix%' is one range scan of the column's index, which also yields the order.
+    """
+    key = (column, prefix, offset)
+    page = lookup_cache.get(key)
+    if page is None:
+        with session_scope() as session:
+            rows = session.execute(
+                select(User.user_id, User.username, User.wallet_address)
+                .where(LOOKUP_COLUMNS[column].like(like_prefix(prefix), escape='/'))
+                .order_by(LOOKUP_COLUMNS[column], User.id)
+                .offset(offset)
+                .limit(LOOKUP_PAGE_SIZE + 1)
+            ).all()
+        page = (tuple(LookupResult(*row) for row in rows[:LOOKUP_PAGE_SIZE]), len(rows) > LOOKUP_PAGE_SIZE)
+        lookup_cache.set(key, page)
+    return page
+
+def lookup_keyboard(column: str, prefix: str, offset: int, results, more: bool) -> InlineKeyboardMarkup:
+    # Callback data stays within Telegram's 64 bytes, prefixes are at most 34 characters
+    keyboard = []
+    for result in results:
+        label = f'@{result.username}' if result.username else str(result.user_id)
+        if result.wallet_address:
+            label += f' · {result.wallet_address[:6]}…{result.wallet_address[-4:]}'
+        keyboard.append((InlineKeyboardButton(label, callback_data=f'lookup_pick:{result.user_id}'),))
+    pages = []
+    if offset:
+        pages.append(InlineKeyboardButton('⬅️上一页', callback_data=f'lookup:{column}:{max(0, offset - LOOKUP_PAGE_SIZE)}:{prefix}'))
+    if more:
+        pages.append(InlineKeyboardButton('下一页➡️', callback_data=f'lookup:{column}:{offset + LOOKUP_PAGE_SIZE}:{prefix}'))
+    if pages:
+        keyboard.append(tuple(pages))
+    return InlineKeyboardMarkup(tuple(keyboard))
+
+def lookup_page_text(prefix: str, offset: int) -> str:
+    return f'以 {prefix} 开头的用户（第 {offset // LOOKUP_PAGE_SIZE + 1} 页），请选择：'
+
+def choose_wish_user(update: Update, context: CallbackContext, user_id) -> int:
+    user = get_user_snapshot(user_id)
+    if user and user.wish:
+        if user.wish_claimed:
+            reply(update, '愿望已实现。')
+            return ConversationHandler.END
+        reply(update, f'用户： {user.username}\n愿望： {user.wish}\n钱包地址： {user.wallet_address}\n最后更新时间： {datetime.now():%Y-%m-%d %H:%M}\n目前邀请人数：{user.invitees_count}')
+        reply(update, '留下你的备注或者使用/cancel取消')
+        context.user_data['user_id'] = user.user_id  # Store user_id in context
+        return WISH_COME_TRUE
+    reply(update, '用户没有愿望，请重新输入或者使用/cancel取消')
     return WISH_COME_TRUE_READY
 
 def receive_wish_come_true(update: Update, context: CallbackContext) -> int:
-    user_id = update.message.text
-    with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user and user.wish:
-            if user.wish_claimed:
-                update.message.reply_text('愿望已实现。')
-                return ConversationHandler.END
-            update.message.reply_text(f'用户： {user.username}\n愿望： {user.wish}\n钱包地址： {user.wallet_address}\n最后更新时间： {datetime.now():%Y-%m-%d %H:%M}\n目前邀请人数：{user.invitees_count}')
-            update.message.reply_text('留下你的备注或者使用/cancel取消')
-            context.user_data['user_id'] = user_id  # Store user_id in context
-        else:
-            update.message.reply_text('用户没有愿望')
-    return WISH_COME_TRUE
+    parsed = parse_lookup_query(update.message.text)
+    if parsed is None:
+        reply(update, f'请输入用户ID、@用户名或钱包地址，搜索至少需要{LOOKUP_MIN_PREFIX}个字符')
+        return WISH_COME_TRUE_READY
+    column, prefix = parsed
+    if column == 'id':
+        return choose_wish_user(update, context, prefix)
+    results, more = search_users(column, prefix)
+    if not results and column == 'w':
+        column = 'u'
+        results, more = search_users(column, prefix)
+    if not results:
+        reply(update, '没有找到用户，请重新输入或者使用/cancel取消')
+        return WISH_COME_TRUE_READY
+    if len(results) == 1 and not more:
+        return choose_wish_user(update, context, results[0].user_id)
+    reply(update, lookup_page_text(prefix, 0), reply_markup=lookup_keyboard(column, prefix, 0, results, more))
+    return WISH_COME_TRUE_READY
+
+def lookup_button(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    outbox.answer_callback_query(query.message.chat_id, query.id)
+    action, _, data = query.data.partition(':')
+    if action == 'lookup_pick':
+        return choose_wish_user(update, context, data)
+    column, offset, prefix = data.split(':', 2)
+    results, more = search_users(column, prefix, int(offset))
+    outbox.edit_message_text(query.message.chat_id, query.message.message_id, lookup_page_text(prefix, int(offset)), reply_markup=lookup_keyboard(column, prefix, int(offset), results, more))
+    return None  # stay in the current state
 
 def wish_come_true(update: Update, context: CallbackContext) -> int:
     remark = update.message.text
     user_id = context.user_data['user_id']
     with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
+        user = get_user(session, user_id)
         if user:
+            count_stat(session, 'claimed', int(not user.wish_claimed))
             user.wish_claimed = True
             session.commit()
-            winner_message = '🎉恭喜用户 <a href="tg://user?id={0}">@{1}</a> 愿望成真\n\n🎁 您的愿望为 <b>{2}</b>\n💬备注：{3}\n\n🧧中奖地址：<code>{4}</code>'.format(user.user_id, user.username, user.wish, remark if remark else '', user.wallet_address if user.wallet_address else '暂未提交')
-            winner_keyboard = [
-                [InlineKeyboardButton("📢需关注频道才能参与活动", url=channel_info.invite_link)],
-                [InlineKeyboardButton("山川公群", url=f"https://t.me/scgq"), InlineKeyboardButton("山川担保", url=f"https://t.me/scdb")]
-            ]
-            reply_markup = InlineKeyboardMarkup(winner_keyboard)
-            for id in [user_id, group_info.id]:
-                response = bot.send_message(chat_id=id, parse_mode=ParseMode.HTML,text=winner_message, reply_markup=reply_markup)
+            winner_message = format_winner_message(user, remark)
+            reply_markup = get_winner_keyboard()
+            for id, priority in [(user_id, PRIORITY_USER), (bot_metadata.group.id, PRIORITY_ADMIN)]:
+                future = outbox.send_message(id, winner_message, priority=priority, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
                 # Log the send message results
-                logger.info(f"Message sent to {id}: {response}")
-            invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = get_invitees_stats(user_id)
-            send_group_message(user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
+                future.add_done_callback(log_delivery(id))
+            mark_dashboard_dirty(user_id)
             return ConversationHandler.END
 
     with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
+        user = get_user(session, user_id)
         if user:
+            count_stat(session, 'claimed', int(not user.wish_claimed))
             user.wish_claimed = True
             session.commit()
-            update.message.reply_text('愿望已实现。谢谢!')
+            reply(update, '愿望已实现。谢谢!')
     return ConversationHandler.END
 
+def user_mention(user) -> str:
+    """HTML link to a user labelled with the @username, else the name, else the ID."""
+    label = f'@{user.username}' if user.username else user.name or str(user.user_id)
+    return f'<a href="tg://user?id={user.user_id}">{html.escape(label)}</a>'
+
+def format_winner_message(user, remark=None) -> str:
+    # Wishes, remarks and wallets are free text, one stray < would get the whole message rejected
+    return '🎉恭喜用户 {0} 愿望成真\n\n🎁 您的愿望为 <b>{1}</b>\n💬备注：{2}\n\n🧧中奖地址：<code>{3}</code>'.format(user_mention(user), html.escape(user.wish or ''), html.escape(remark) if remark else '', html.escape(user.wallet_address) if user.wallet_address else '暂未提交')
+
+def get_winner_keyboard():
+    return winner_keyboard(bot_metadata.channel.invite_link)
+
+@functools.lru_cache(maxsize=4)
+def winner_keyboard(invite_link: str):
+    return InlineKeyboardMarkup((
+        (InlineKeyboardButton("📢需关注频道才能参与活动", url=invite_link),),
+        (InlineKeyboardButton("山川公群", url=f"https://t.me/scgq"), InlineKeyboardButton("山川担保", url=f"https://t.me/scdb")),
+    ))
+
+# Batch draw, every eligible user has weight 1 + invitees_count
+WINNER_CONDITIONS = (User.wish != None, User.wallet_address != None, User.is_subscribed == True, User.wish_claimed.isnot(True))
+WINNERS_PER_ANNOUNCEMENT = 20
+
+class WeightIndex:
+    """Fenwick tree over integer weights, sampling and updating an item in O(log n)."""
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        self.size = len(self.weights)
+        self.total = sum(self.weights)
+        self.tree = [0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def set(self, index: int, weight: int) -> None:
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def remove(self, index: int) -> None:
+        self.set(index, 0)
+
+    def sample(self, rng: random.Random) -> int:
+        """Index of the item whose cumulative weight range holds a uniform draw."""
+        target = rng.randrange(self.total)
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if position + step <= self.size and self.tree[position + step] <= target:
+                position += step
+                target -= self.tree[position]
+            step >>= 1
+        return position
+
+class DrawPool:
+    """Draw weight 1 + invitees_count of every eligible user, slotted by users.id in a WeightIndex.
+
+    Loaded once and kept current from the user IDs of committed transactions, which are
+    re-read just before the next draw, so a draw reads only users changed since the last
+    one. Slots follow users.id, so the same seed over the same eligible users and weights
+    draws the same winners. Writes of other processes show up at the next reload().
+    """
+
+    def __init__(self):
+        self.index = WeightIndex(())
+        # users.id <-> user_id of the users holding a weight
+        self.user_ids = {}
+        self.ids = {}
+        self.loaded = False
+        # Changes are collected from the start of the first load, nobody reads them before
+        self.tracking = False
+        self.stale = set()
+        self.stale_lock = threading.Lock()
+        # Held for a whole draw
+        self.lock = threading.Lock()
+
+    def mark_stale(self, user_ids) -> None:
+        if self.tracking:
+            with self.stale_lock:
+                self.stale.update(user_ids)
+
+    def reload(self) -> None:
+        with self.stale_lock:
+            self.tracking = True
+            self.stale.clear()
+        with session_scope() as session:
+            rows = session.execute(select(User.id, User.user_id, User.invitees_count).where(*WINNER_CONDITIONS)).all()
+        weights = [0] * (max((id for id, _, _ in rows), default=0) + 1)
+        for id, _, invitees_count in rows:
+            weights[id] = 1 + (invitees_count or 0)
+        with self.lock:
+            self.index = WeightIndex(weights)
+            self.user_ids = {id: user_id for id, user_id, _ in rows}
+            self.ids = {user_id: id for id, user_id, _ in rows}
+            self.loaded = True
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            self.reload()
+
+    def refresh(self, session) -> None:
+        """Re-read the users changed since the last draw, the caller holds the lock."""
+        with self.stale_lock:
+            stale, self.stale = sorted(self.stale), set()
+        eligible = case((and_(*WINNER_CONDITIONS), 1), else_=0)
+        for start_at in range(0, len(stale), 1000):
+            chunk = stale[start_at:start_at + 1000]
+            rows = session.execute(select(User.id, User.user_id, User.invitees_count, eligible).where(User.user_id.in_(chunk))).all()
+            for id, user_id, invitees_count, is_eligible in rows:
+                self.assign(id, user_id, 1 + (invitees_count or 0) if is_eligible else 0)
+            for user_id in set(chunk) - {row.user_id for row in rows}:
+                if user_id in self.ids:
+                    self.assign(self.ids[user_id], user_id, 0)
+
+    def assign(self, id: int, user_id: int, weight: int) -> None:
+        if id >= self.index.size:
+            # Grown by doubling, new users get ever higher ids
+            self.index = WeightIndex(self.index.weights + [0] * max(id + 1 - self.index.size, self.index.size))
+        self.index.set(id, weight)
+        if weight:
+            self.user_ids[id], self.ids[user_id] = user_id, id
+        else:
+            self.user_ids.pop(id, None)
+            self.ids.pop(user_id, None)
+
+draw_pool = DrawPool()
+
+def draw_winners(count: int, seed: int) -> list:
+    """Draw up to count winners without replacement and mark them claimed in one transaction.
+
+    Samples the draw pool, refreshed from the users changed since the last draw, instead
+    of reading every eligible row.
+    """
+    rng = random.Random(seed)
+    draw_pool.ensure_loaded()
+    with draw_pool.lock, session_scope() as session:
+        draw_pool.refresh(session)
+        index = draw_pool.index
+        eligible = len(draw_pool.user_ids)
+        # Picks are taken out while drawing and put back after, winners leave once their claim commits
+        drawn = {}
+        winner_ids = []
+        try:
+            while len(winner_ids) < count and index.total:
+                picks = []
+                while len(winner_ids) + len(picks) < count and index.total:
+                    i = index.sample(rng)
+                    drawn[i] = index.weights[i]
+                    index.remove(i)
+                    picks.append(draw_pool.user_ids[i])
+                # Lock the picks, anyone claimed or changed since the pool was refreshed is redrawn
+                locked = {user_id for user_id, in session.query(User.user_id).filter(User.user_id.in_(picks), *WINNER_CONDITIONS).with_for_update()}
+                winner_ids += [user_id for user_id in picks if user_id in locked]
+        finally:
+            for i, weight in drawn.items():
+                index.set(i, weight)
+        if not winner_ids:
+            return []
+        session.query(User).filter(User.user_id.in_(winner_ids)).update({User.wish_claimed: True}, synchronize_session=False)
+        count_stat(session, 'claimed', len(winner_ids))
+        mark_users_stale(session, winner_ids)
+        winners = {user.user_id: user for user in session.query(User.user_id, User.username, User.name, User.wish, User.wallet_address).filter(User.user_id.in_(winner_ids))}
+    logger.info(f'Drew {len(winner_ids)} winners from {eligible} eligible users with seed {seed}')
+    return [winners[user_id] for user_id in winner_ids]
+
+def draw(update: Update, context: CallbackContext) -> None:
+    """/draw <count> [seed], announces the winners through the outbox."""
+    if update.effective_user.id not in admins:
+        reply(update, '你没有权限使用此功能')
+        return
+    if not context.args or not all(arg.isdigit() for arg in context.args[:2]):
+        reply(update, '用法：/draw 中奖人数 [随机种子]')
+        return
+    count = int(context.args[0])
+    seed = int(context.args[1]) if len(context.args) > 1 else random.SystemRandom().randrange(2 ** 32)
+    winners = draw_winners(count, seed)
+    if not winners:
+        reply(update, '没有符合条件的用户')
+        return
+    reply_markup = get_winner_keyboard()
+    for user in winners:
+        outbox.send_message(user.user_id, format_winner_message(user), priority=PRIORITY_ADMIN, parse_mode=ParseMode.HTML, reply_markup=reply_markup).add_done_callback(log_delivery(user.user_id))
+        mark_dashboard_dirty(user.user_id)
+    for start_at in range(0, len(winners), WINNERS_PER_ANNOUNCEMENT):
+        lines = [f'{user_mention(user)}：<b>{html.escape(user.wish or "")}</b>' for user in winners[start_at:start_at + WINNERS_PER_ANNOUNCEMENT]]
+        outbox.send_message(bot_metadata.group.id, '🎉恭喜以下用户愿望成真\n\n' + '\n'.join(lines), priority=PRIORITY_ADMIN, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    reply(update, f'已抽出 {len(winners)} 位中奖用户，随机种子：{seed}')
+
 def make_wish(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
     with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
         is_subscribed = is_user_subscribed(user_id)
+        user = get_user_snapshot(user_id)
         logger.info(f'User: {user} & is_subscribed: {is_subscribed}')
         if user and is_subscribed:
-            with session_scope() as session:
-                invite = session.query(Invite).filter_by(invitee_id=user_id).first()
-                if invite:
-                    inviter = session.query(User).filter_by(user_id=invite.user_id).first()
-                    invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = get_invitees_stats(inviter.user_id)
-                    send_group_message(inviter.user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
+            invite = session.query(Invite).filter_by(invitee_id=user_id).first()
+            if invite:
+                mark_dashboard_dirty(invite.user_id)
 
             if user.wallet_address:
                 if user.wish:
-                    update.message.reply_text(f'目前愿望：<i>{user.wish}</i>\n请写下你新的愿望\n或使用/cancel取消', parse_mode=ParseMode.HTML)
+                    reply(update, f'目前愿望：<i>{html.escape(user.wish)}</i>\n请写下你新的愿望\n或使用/cancel取消', parse_mode=ParseMode.HTML)
                 else:
-                    update.message.reply_text('请写下你的愿望\n使用/cancel取消')
+                    reply(update, '请写下你的愿望\n使用/cancel取消')
                 return WISH
             else:
-                update.message.reply_text('请先按绑定钱包按钮绑定钱包地址')
+                reply(update, '请先按绑定钱包按钮绑定钱包地址')
         else:
             message, reply_markup = subscribe_channel_message()
-            update.message.reply_text(message, reply_markup=reply_markup)
+            reply(update, message, reply_markup=reply_markup)
 
 def get_invitees_stats(user_id):
-    with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        invitees = session.query(Invite).filter_by(user_id=user_id).all()
-        invitees_subscribed_count = session.query(User).filter(User.user_id.in_([invitee.invitee_id for invitee in invitees]), User.is_subscribed == True).count()
-        # count the number of invitees who have written down their wishes
-        invitees_wish_count = session.query(User).filter(User.user_id.in_([invitee.invitee_id for invitee in invitees]), User.wish != None).count()
-        if user.invitees_count > 0:
-            invitees_subscribed_rate = invitees_subscribed_count / user.invitees_count
-            invitees_wish_rate = invitees_wish_count / user.invitees_count
-        else:
-            invitees_subscribed_rate = 0
-            invitees_wish_rate = 0
-        return invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate
+    user = get_user_snapshot(user_id)
+    invitees_subscribed_count = user.invitees_subscribed_count or 0
+    invitees_wish_count = user.invitees_wish_count or 0
+    if user.invitees_count > 0:
+        invitees_subscribed_rate = invitees_subscribed_count / user.invitees_count
+        invitees_wish_rate = invitees_wish_count / user.invitees_count
+    else:
+        invitees_subscribed_rate = 0
+        invitees_wish_rate = 0
+    return invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate
+
+def store_group_message_id(user_id):
+    """Build a callback that saves the admin-group card's message_id once it is sent."""
+    def callback(future: Future) -> None:
+        with dashboard_lock:
+            cards_in_flight.discard(user_id)
+        if future.exception() or not future.result():
+            return
+        with session_scope() as session:
+            user = get_user(session, user_id)
+            if user:
+                user.message_id = future.result().message_id
+    return callback
+
+def resend_missing_card(user_id):
+    """Build a callback that posts a fresh card when the old one was deleted."""
+    def callback(future: Future) -> None:
+        with dashboard_lock:
+            cards_in_flight.discard(user_id)
+        if isinstance(future.exception(), BadRequest) and 'message to edit not found' in str(future.exception()):
+            with session_scope() as session:
+                user = get_user(session, user_id)
+                if user:
+                    user.message_id = None
+            mark_dashboard_dirty(user_id)
+    return callback
 
 def send_group_message(user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate) -> None:
     with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        message = None
-        text_message = f'用户：<a href="tg://user?id={user.user_id}">{user.username}</a>\n用户id：<code>{user.user_id}</code>\n愿望：<b>{user.wish}</b>\n钱包地址：<code>{user.wallet_address}</code>\n最后更新时间：{datetime.now():%Y-%m-%d %H:%M}\n目前邀请人数：{user.invitees_count}\n邀请者关注频道人数：{invitees_subscribed_count}\n邀请者关注频道率：{invitees_subscribed_rate:.0%}\n邀请者写下愿望人数：{invitees_wish_count}\n邀请者写下愿望率：{invitees_wish_rate:.0%}'
-
+        user = get_user(session, user_id)
+        text_message = f'用户：{user_mention(user)}\n用户id：<code>{user.user_id}</code>\n愿望：<b>{html.escape(str(user.wish))}</b>\n钱包地址：<code>{html.escape(str(user.wallet_address))}</code>\n最后更新时间：{datetime.now():%Y-%m-%d %H:%M}\n目前邀请人数：{user.invitees_count}\n邀请者关注频道人数：{invitees_subscribed_count}\n邀请者关注频道率：{invitees_subscribed_rate:.0%}\n邀请者写下愿望人数：{invitees_wish_count}\n邀请者写下愿望率：{invitees_wish_rate:.0%}'
+        if user.wish_claimed:
+            text_message += '\n\n[✨愿望已实现]'
+
+        with dashboard_lock:
+            cards_in_flight.add(user_id)
+        if not user.message_id:
+            future = outbox.send_message(bot_metadata.admin_group.id, text_message, priority=PRIORITY_ADMIN, parse_mode=ParseMode.HTML)
+            future.add_done_callback(store_group_message_id(user_id))
+        else:
+            future = outbox.edit_message_text(bot_metadata.admin_group.id, user.message_id, text_message, parse_mode=ParseMode.HTML)
+            future.add_done_callback(resend_missing_card(user_id))
+            write_behind.increment(user_id, 'update_count')
+        return future
+
+# Admin-group dashboard: handlers only mark inviters dirty, the scheduler refreshes
+# each dirty card at most once per DASHBOARD_FLUSH_INTERVAL
+dirty_users = set()
+cards_in_flight = set()
+dashboard_lock = threading.Lock()
+
+def mark_dashboard_dirty(user_id) -> None:
+    with dashboard_lock:
+        dirty_users.add(int(user_id))
+
+def flush_dashboard() -> None:
+    global dirty_users
+    with dashboard_lock:
+        # Cards with a send or edit still queued in the outbox wait for the next flush
+        batch = dirty_users - cards_in_flight
+        dirty_users = dirty_users & cards_in_flight
+    for user_id in batch:
         try:
-            if not user.message_id:
-                message = bot.send_message(chat_id=admin_group_info.id, text=text_message, parse_mode=ParseMode.HTML)
-                user.message_id = message.message_id
-                session.commit()
-            else:
-                if user.wish_claimed:
-                    message = bot.edit_message_text(chat_id=admin_group_info.id, message_id=user.message_id, parse_mode=ParseMode.HTML, text=text_message + '\n\n[✨愿望已实现]')
-                else:
-                    if user.update_count < 5:
-                        # message = bot.edit_message_text(chat_id=admin_group_info.id, message_id=user.message_id, parse_mode=ParseMode.HTML, text=text_message)
-                        user.update_count += 1
-                        session.commit()
-                    else:
-                        message = bot.send_message(chat_id=admin_group_info.id, parse_mode=ParseMode.HTML, text=text_message)
-                        user.message_id = message.message_id
-                        user.update_count = 0
-                        session.commit()
-        except BadRequest as e:
-            if 'Message is not modified' in str(e):
-                pass
-            else:
-                raise e
-        return message
+            with session_scope():
+                invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = get_invitees_stats(user_id)
+                send_group_message(user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
+        except Exception as e:
+            logger.exception(e)
+
 
 def get_link_keyboard_button():
-    keyboard = [
-        [InlineKeyboardButton("点我关注频道后参加活动", url=channel_info.invite_link)],
-        [InlineKeyboardButton("愿望成真公示群", url="https://t.me/+GM7dYLjgeyg1ZmE0")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return reply_markup
+    return link_keyboard(bot_metadata.channel.invite_link)
+
+@functools.lru_cache(maxsize=4)
+def link_keyboard(invite_link: str):
+    return InlineKeyboardMarkup((
+        (InlineKeyboardButton("点我关注频道后参加活动", url=invite_link),),
+        (InlineKeyboardButton("愿望成真公示群", url="https://t.me/+GM7dYLjgeyg1ZmE0"),),
+    ))
 
 def get_my_invitees(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            text_message = f'🥇 TRC20地址：<code>{user.wallet_address if user.wallet_address else "暂未提交"}</code>\n\n🥈 用户名：@{user.username}\n\n🥉 用户ID：<code>{user.user_id}</code>\n\n🔮 邀请人数：<b>{user.invitees_count}</b>'
-            update.message.reply_text(text_message, reply_markup=get_link_keyboard_button(), parse_mode=ParseMode.HTML)
+    user = get_user_snapshot(user_id)
+    if user:
+        text_message = f'🥇 TRC20地址：<code>{html.escape(user.wallet_address) if user.wallet_address else "暂未提交"}</code>\n\n🥈 用户名：@{user.username}\n\n🥉 用户ID：<code>{user.user_id}</code>\n\n🔮 邀请人数：<b>{user.invitees_count}</b>'
+        rank = invite_ranking.rank(user_id)
+        if rank:
+            text_message += f'\n\n🏆 邀请排名：第 <b>{rank}</b> 名'
+        reply(update, text_message, reply_markup=get_link_keyboard_button(), parse_mode=ParseMode.HTML)
+
+# Rendered leaderboard, shared by everyone asking within LEADERBOARD_CACHE_TTL
+leaderboard_cache = TTLCache(LEADERBOARD_CACHE_TTL, 1)
+
+def render_leaderboard() -> str:
+    lines = []
+    for rank, user_id, count in invite_ranking.top(LEADERBOARD_SIZE):
+        user = get_user_snapshot(user_id)
+        name = f'@{user.username}' if user and user.username else html.escape(user.name) if user and user.name else user_id
+        lines.append(f'{rank}. {name} - <b>{count}</b>人')
+    return '🏆 邀请排行榜\n\n' + ('\n'.join(lines) if lines else '暂无邀请记录')
+
+def leaderboard(update: Update, context: CallbackContext) -> None:
+    text_message = leaderboard_cache.get('leaderboard')
+    if text_message is None:
+        text_message = render_leaderboard()
+        leaderboard_cache.set('leaderboard', text_message)
+    rank = invite_ranking.rank(update.effective_user.id)
+    text_message += f'\n\n你的排名：第 <b>{rank}</b> 名' if rank else '\n\n你还没有邀请记录'
+    reply(update, text_message, parse_mode=ParseMode.HTML)
+
+def stats(update: Update, context: CallbackContext) -> None:
+    """Campaign funnel from the rollups, constant time whatever the table sizes."""
+    if update.effective_user.id not in admins:
+        reply(update, '你没有权限使用此功能')
+        return
+    totals, hourly = campaign_stats.read(STATS_HOURS)
+    users = totals['users']
+    def share(name):
+        return f'{totals[name]}（{totals[name] / users:.1%}）' if users else '0'
+    lines = [
+        '📊 活动数据',
+        f'总用户：{users}',
+        f'已关注频道：{share("subscribed")}',
+        f'已绑定钱包：{share("wallets")}',
+        f'已许愿：{share("wishes")}',
+        f'已实现愿望：{totals["claimed"]}',
+        f'邀请总数：{totals["invites"]}',
+        '',
+        f'最近{STATS_HOURS}小时（新用户/许愿/邀请）：',
+    ]
+    for (hour, new_users), (_, wishes), (_, invites) in zip(hourly['users'], hourly['wishes'], hourly['invites']):
+        lines.append(f'{hour[5:10]} {hour[11:]}:00  {new_users} / {wishes} / {invites}')
+    reply(update, '\n'.join(lines))
 
 def receive_wish(update: Update, context: CallbackContext) -> int:
     wish_text = update.message.text
     user_id = update.effective_user.id
 
     with session_scope() as session:
-        user = session.query(User).filter_by(user_id=user_id).first()
+        user = get_user(session, user_id)
         if user:
             if not user.wish:
                 user.wish = wish_text
                 user.wish_date = datetime.now()
+                bump_inviter_counters(session, user_id, wishes=1)
+                count_stat(session, 'wishes')
                 invite_link = generate_unique_link(user_id)
                 session.commit()
-                invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = 0, 0, 0, 0
-                message = send_group_message(user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
-                bot.send_message(chat_id=user_id, text=f"✅愿望已记录。谢谢！\n\n🏮<i>您的愿望已放飞，邀请人数越多愿望成真几率越大</i>\n🔥\n\n🔗你的邀请链接： {invite_link}", parse_mode=ParseMode.HTML)
+                mark_dashboard_dirty(user_id)
+                outbox.send_message(user_id, f"✅愿望已记录。谢谢！\n\n🏮<i>您的愿望已放飞，邀请人数越多愿望成真几率越大</i>\n🔥\n\n🔗你的邀请链接： {invite_link}", parse_mode=ParseMode.HTML)
             elif user.wish_claimed:
-                update.message.reply_text('愿望已经实现，不能再许愿。')
+                reply(update, '愿望已经实现，不能再许愿。')
             else:
                 user.wish = wish_text
                 user.wish_date = datetime.now()
                 session.commit()
-                invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = get_invitees_stats(user_id)
-                send_group_message(user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
-                update.message.reply_text(f'✅愿望已更新。谢谢!\n\n目前愿望：<i>{user.wish}</i>', parse_mode=ParseMode.HTML)
+                mark_dashboard_dirty(user_id)
+                reply(update, f'✅愿望已更新。谢谢!\n\n目前愿望：<i>{html.escape(user.wish)}</i>', parse_mode=ParseMode.HTML)
             invite = session.query(Invite).filter_by(invitee_id=user_id).first()
             if invite:
-                inviter = session.query(User).filter_by(user_id=invite.user_id).first()
-                invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = get_invitees_stats(inviter.user_id)
-                send_group_message(inviter.user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
+                mark_dashboard_dirty(invite.user_id)
     return ConversationHandler.END
 
 def cancel(update: Update, context: CallbackContext) -> int:
-    update.message.reply_text('操作已取消。')
+    reply(update, '操作已取消。')
     return ConversationHandler.END
 
 # Define ConversationHandler
@@ -348,14 +2044,21 @@ WALLET = 2
 WISH_COME_TRUE_READY =3
 WISH_COME_TRUE = 4
 
-wish_come_true_handler = ConversationHandler(
-    entry_points=[MessageHandler(Filters.regex('^🌟实现愿望$'), make_wish_come_true)],
-    states={
-        WISH_COME_TRUE_READY: [MessageHandler(Filters.text & ~Filters.command, receive_wish_come_true)],
-        WISH_COME_TRUE: [MessageHandler(Filters.text & ~Filters.command, wish_come_true)],
-    },
-    fallbacks=[CommandHandler('cancel', cancel)],
-)
+lookup_button_handler = CallbackQueryHandler(lookup_button, pattern='^lookup')
+
+# Lookup buttons only ever answer the admin who searched, tracking them per chat and user is intended
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', message="If 'per_message=False'")
+    wish_come_true_handler = ConversationHandler(
+        entry_points=[MessageHandler(Filters.regex('^🌟实现愿望$'), make_wish_come_true)],
+        states={
+            WISH_COME_TRUE_READY: [MessageHandler(Filters.text & ~Filters.command, receive_wish_come_true), lookup_button_handler],
+            WISH_COME_TRUE: [MessageHandler(Filters.text & ~Filters.command, wish_come_true), lookup_button_handler],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='wish_come_true',
+        persistent=True,
+    )
 
 make_wish_handler = ConversationHandler(
     entry_points=[MessageHandler(Filters.regex('^🏮写下愿望$'), make_wish)],
@@ -363,6 +2066,8 @@ make_wish_handler = ConversationHandler(
         WISH: [MessageHandler(Filters.text & ~Filters.command, receive_wish)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name='make_wish',
+    persistent=True,
 )
 
 bind_wallet_address_handler = ConversationHandler(
@@ -371,85 +2076,671 @@ bind_wallet_address_handler = ConversationHandler(
         WALLET: [MessageHandler(Filters.text & ~Filters.command, receive_wallet_address)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name='bind_wallet_address',
+    persistent=True,
 )
 
+def set_user_subscribed(user_id, is_subscribed: bool) -> None:
+    """Record a user's channel membership in the cache and the database."""
+    subscription_cache.set(user_id, is_subscribed)
+    snapshot = get_user_snapshot(user_id)
+    if snapshot is not None:
+        write_behind.subscribe(user_id, is_subscribed, bool(snapshot.is_subscribed))
+
 def is_user_subscribed(user_id):
+    is_subscribed = subscription_cache.get(user_id)
+    if is_subscribed is not None:
+        return is_subscribed
     try:
         chat_member = bot.get_chat_member(chat_id=os.getenv('CHANNEL_NAME'), user_id=user_id)
         is_subscribed = chat_member.status not in ('left', 'kicked')
+    except Exception as e:
+        logger.exception(e)
+        return False
 
-        # Update the user's status in the database
+    # Update the user's status in the database
+    set_user_subscribed(user_id, is_subscribed)
+    return is_subscribed
+
+def apply_subscription_changes(session, statuses: dict) -> set:
+    """Write channel memberships for many users with bulk UPDATEs, in the caller's transaction.
+
+    statuses maps user_id to is_subscribed. Rows are locked while comparing so a
+    concurrent handler can't flip a user between the check and the counter update.
+    Returns the inviters whose invitee counters changed.
+    """
+    current = session.query(User.user_id, User.is_subscribed).filter(User.user_id.in_(list(statuses))).with_for_update().all()
+    changed = {user_id: statuses[user_id] for user_id, is_subscribed in current if bool(is_subscribed) != statuses[user_id]}
+    if not changed:
+        return set()
+    for value in (True, False):
+        user_ids = [user_id for user_id, is_subscribed in changed.items() if is_subscribed == value]
+        if user_ids:
+            session.query(User).filter(User.user_id.in_(user_ids)).update({User.is_subscribed: value}, synchronize_session=False)
+    deltas = defaultdict(int)
+    for inviter_id, invitee_id in session.query(Invite.user_id, Invite.invitee_id).filter(Invite.invitee_id.in_(list(changed))):
+        deltas[inviter_id] += 1 if changed[invitee_id] else -1
+    deltas = {inviter_id: delta for inviter_id, delta in deltas.items() if delta}
+    if deltas:
+        session.query(User).filter(User.user_id.in_(list(deltas))).update({
+            User.invitees_subscribed_count: User.invitees_subscribed_count + case(deltas, value=User.user_id, else_=0),
+        }, synchronize_session=False)
+    mark_users_stale(session, list(changed) + list(deltas))
+    count_stat(session, 'subscribed', sum(1 if is_subscribed else -1 for is_subscribed in changed.values()))
+    return set(deltas)
+
+class WriteBehind:
+    """Buffers writes of low-value user fields and applies them in bulk.
+
+    Repeated writes to a user collapse in memory, assignments keep the latest value and
+    increments add up. flush() runs on a scheduler tick, as soon as WRITE_BEHIND_MAX_ROWS
+    users are pending and on shutdown. Wishes, wallets and invites never go through here.
+    """
+
+    def __init__(self, max_rows: int):
+        self.max_rows = max_rows
+        self.assignments = defaultdict(dict)  # column -> {user_id: value}
+        self.increments = defaultdict(dict)   # column -> {user_id: delta}
+        self.subscriptions = {}               # user_id -> is_subscribed
+        self.users = set()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def assign(self, user, **values) -> None:
+        """Buffer the values that differ from the loaded user row."""
+        changed = {column: value for column, value in values.items() if getattr(user, column) != value}
+        if changed:
+            with self.lock:
+                for column, value in changed.items():
+                    self.assignments[column][user.user_id] = value
+                self.added(user.user_id)
+
+    def increment(self, user_id: int, column: str, delta: int = 1) -> None:
+        with self.lock:
+            self.increments[column][user_id] = self.increments[column].get(user_id, 0) + delta
+            self.added(user_id)
+
+    def subscribe(self, user_id: int, is_subscribed: bool, stored: bool) -> None:
+        """Buffer a channel membership differing from the stored one, flushed with its inviter counter updates."""
+        with self.lock:
+            # A pending write makes the stored value stale, so it is always replaced
+            if user_id in self.subscriptions or is_subscribed != stored:
+                self.subscriptions[user_id] = is_subscribed
+                self.added(user_id)
+
+    def discard_subscription(self, user_id: int) -> None:
+        """Drop a pending membership the caller is about to write synchronously."""
+        with self.lock:
+            self.subscriptions.pop(user_id, None)
+
+    def added(self, user_id: int) -> None:
+        # Called with the lock held
+        self.users.add(user_id)
+        if len(self.users) == self.max_rows:
+            threading.Thread(target=self.flush, name='write-behind', daemon=True).start()
+
+    def pending(self) -> int:
+        return len(self.users)
+
+    def flush(self, wait: bool = False) -> None:
+        if not self.flush_lock.acquire(blocking=wait):
+            # Another flush is running, it or the next tick takes the rest
+            return
+        try:
+            with self.lock:
+                assignments, increments, subscriptions, users = self.assignments, self.increments, self.subscriptions, self.users
+                self.assignments, self.increments, self.subscriptions, self.users = defaultdict(dict), defaultdict(dict), {}, set()
+            if not users:
+                return
+            try:
+                inviters = self.write(assignments, increments, subscriptions)
+            except Exception as e:
+                logger.exception(e)
+                self.restore(assignments, increments, subscriptions)
+                return
+            for inviter_id in inviters:
+                mark_dashboard_dirty(inviter_id)
+            metrics.inc('write_behind_rows_total', len(users))
+            logger.debug(f'Wrote behind {len(users)} users')
+        finally:
+            self.flush_lock.release()
+
+    def write(self, assignments, increments, subscriptions) -> set:
+        """One transaction of CASE updates over chunks of max_rows users, returns inviters whose counters changed."""
         with session_scope() as session:
-            user = session.query(User).filter_by(user_id=user_id).first()
-            if user:
-                user.is_subscribed = is_subscribed
-                session.commit()
+            for column, values in assignments.items():
+                for chunk in chunked(values, self.max_rows):
+                    session.query(User).filter(User.user_id.in_(list(chunk))).update({
+                        getattr(User, column): case(chunk, value=User.user_id),
+                    }, synchronize_session=False)
+            for column, deltas in increments.items():
+                for chunk in chunked(deltas, self.max_rows):
+                    session.query(User).filter(User.user_id.in_(list(chunk))).update({
+                        getattr(User, column): func.coalesce(getattr(User, column), 0) + case(chunk, value=User.user_id, else_=0),
+                    }, synchronize_session=False)
+            inviters = set()
+            for chunk in chunked(subscriptions, self.max_rows):
+                inviters |= apply_subscription_changes(session, chunk)
+            mark_users_stale(session, set(itertools.chain(*assignments.values(), *increments.values())))
+        return inviters
+
+    def restore(self, assignments, increments, subscriptions) -> None:
+        # Writes buffered since the failed flush are newer and win
+        with self.lock:
+            for column, values in assignments.items():
+                self.assignments[column] = {**values, **self.assignments[column]}
+            for column, deltas in increments.items():
+                for user_id, delta in deltas.items():
+                    self.increments[column][user_id] = self.increments[column].get(user_id, 0) + delta
+            self.subscriptions = {**subscriptions, **self.subscriptions}
+            self.users |= set(subscriptions) | set(itertools.chain(*assignments.values(), *increments.values()))
+
+def chunked(mapping: dict, size: int):
+    items = list(mapping.items())
+    for start_at in range(0, len(items), size):
+        yield dict(items[start_at:start_at + size])
+
+write_behind = WriteBehind(WRITE_BEHIND_MAX_ROWS)
+
+def sweep_subscriptions(budget: int = SUBSCRIPTION_SWEEP_BUDGET) -> None:
+    """Re-check channel membership of users in id order, spending at most budget getChatMember calls.
+
+    Users with a fresh cached status are skipped. Progress is checkpointed after every
+    batch together with its updates, so a restart resumes where the last run stopped,
+    and the sweep starts over once it reaches the end of the table.
+    """
+    bucket = TokenBucket(SUBSCRIPTION_SWEEP_RATE, capacity=1)
+    checked = 0
+    inviters_changed = set()
+    while budget > 0:
+        with session_scope() as session:
+            checkpoint = session.get(JobCheckpoint, 'subscription_sweep')
+            last_id = checkpoint.last_id if checkpoint else 0
+            rows = session.query(User.id, User.user_id).filter(User.id > last_id, User.user_id != None).order_by(User.id).limit(SUBSCRIPTION_SWEEP_BATCH).all()
+        statuses = {}
+        flood_wait = False
+        for id, user_id in rows:
+            cached = subscription_cache.get(user_id)
+            if cached is None:
+                if budget <= 0:
+                    break
+                now = time.monotonic()
+                time.sleep(max(0.0, bucket.available_at(now) - now))
+                bucket.consume()
+                budget -= 1
+                try:
+                    chat_member = bot.get_chat_member(chat_id=os.getenv('CHANNEL_NAME'), user_id=user_id)
+                except RetryAfter:
+                    flood_wait = True
+                    break
+                except TelegramError as e:
+                    logger.debug(f'Skipping membership of {user_id}: {e}')
+                else:
+                    cached = chat_member.status not in ('left', 'kicked')
+                    subscription_cache.set(user_id, cached)
+                    statuses[user_id] = cached
+            last_id = id
+        finished = len(rows) < SUBSCRIPTION_SWEEP_BATCH and (not rows or last_id == rows[-1][0])
+        with session_scope() as session:
+            inviters = apply_subscription_changes(session, statuses) if statuses else set()
+            # Start over from the first user once the whole table was swept
+            session.merge(JobCheckpoint(name='subscription_sweep', last_id=0 if finished else last_id))
+        for inviter_id in inviters:
+            mark_dashboard_dirty(inviter_id)
+        checked += len(statuses)
+        inviters_changed |= inviters
+        if flood_wait or finished:
+            break
+    metrics.inc('subscription_sweep_checks_total', checked)
+    logger.info(f'Subscription sweep checked {checked} users up to id {last_id}, invitee stats of {len(inviters_changed)} inviters changed')
+
+def track_channel_members(update: Update, context: CallbackContext) -> None:
+    """Keep subscription status current from chat_member updates of the channel."""
+    if update.my_chat_member and update.effective_chat.type == Chat.PRIVATE:
+        # The user blocked or restarted the bot
+        set_user_blocked(update.effective_chat.id, update.my_chat_member.new_chat_member.status == 'kicked')
+        return
+    if update.effective_chat.id != bot_metadata.channel.id:
+        return
+    if update.my_chat_member:
+        # The bot's own membership changed, cached statuses can no longer be trusted
+        subscription_cache.clear()
+        return
+    member = update.chat_member.new_chat_member
+    set_user_subscribed(member.user.id, member.status not in ('left', 'kicked'))
+
+# Admin broadcasts
+BROADCAST_AUDIENCES = {
+    'all': None,
+    'subscribed': User.is_subscribed == True,
+    'wish': User.wish != None,
+    'nowallet': User.wallet_address == None,
+}
+BROADCAST_AUDIENCE_NAMES = {'all': '所有用户', 'subscribed': '已关注频道用户', 'wish': '已许愿用户', 'nowallet': '未绑定钱包用户'}
+
+def set_user_blocked(user_id, blocked: bool) -> None:
+    with session_scope() as session:
+        session.query(User).filter_by(user_id=user_id).update({User.blocked_bot: blocked}, synchronize_session=False)
+        mark_users_stale(session, [user_id])
+
+def broadcast_audience_filter(audience: str) -> list:
+    conditions = [User.user_id != None, User.blocked_bot.isnot(True)]
+    if BROADCAST_AUDIENCES[audience] is not None:
+        conditions.append(BROADCAST_AUDIENCES[audience])
+    return conditions
+
+def broadcast_recipients(audience: str, after_id: int):
+    """Yield (users.id, user_id) of the audience in id order, starting after after_id.
+
+    Recipients are read in keyset pages of BROADCAST_PAGE_SIZE on users.id. Each page is
+    fetched whole and its connection returned to the pool before any row is yielded, so
+    no connection stays checked out across the sends and flood waits in between.
+    """
+    conditions = broadcast_audience_filter(audience)
+    while True:
+        query = select(User.id, User.user_id).where(User.id > after_id, *conditions).order_by(User.id).limit(BROADCAST_PAGE_SIZE)
+        with engine.connect() as connection:
+            rows = connection.execute(query).all()
+        yield from rows
+        if len(rows) < BROADCAST_PAGE_SIZE:
+            return
+        after_id = rows[-1][0]
+
+class Broadcaster(threading.Thread):
+    """Delivers one broadcast through the outbox, checkpointing after every recipient.
+
+    At most BROADCAST_WINDOW sends are queued at a time, so the outbox paces the
+    broadcast at the global send rate while user replies keep their priority. A
+    restarted broadcast skips every recipient the checkpoint records as handled.
+    """
+
+    def __init__(self, broadcast_id: int):
+        super().__init__(name=f'broadcast-{broadcast_id}', daemon=True)
+        self.broadcast_id = broadcast_id
+        self.completed = Queue()
+        self.pending = set()
+        self.stopping = False
+        self.cancelled = False
+        self.progress_posting = False
+
+    def run(self) -> None:
+        try:
+            self.deliver()
+        except Exception as e:
+            logger.exception(e)
 
-        return is_subscribed
+    def deliver(self) -> None:
+        with session_scope() as session:
+            broadcast = session.get(Broadcast, self.broadcast_id)
+            message, audience, self.total = broadcast.message, broadcast.audience, broadcast.total
+            self.last_id = broadcast.last_id or 0
+            self.done = set(json.loads(broadcast.done_ids or '[]'))
+            self.counts = Counter(sent=broadcast.sent or 0, failed=broadcast.failed or 0, blocked=broadcast.blocked or 0)
+            self.progress_message_id = broadcast.progress_message_id
+        self.started = time.monotonic()
+        self.handled_before = sum(self.counts.values())
+        self.report()
+        reported = time.monotonic()
+        finished = False
+        for id, user_id in broadcast_recipients(audience, self.last_id):
+            if id in self.done:
+                continue
+            while len(self.pending) >= BROADCAST_WINDOW and not self.stopping:
+                self.wait()
+            if self.stopping:
+                break
+            self.pending.add(id)
+            self.last_id = id
+            future = outbox.send_message(user_id, message, priority=PRIORITY_BROADCAST, parse_mode=ParseMode.HTML)
+            future.add_done_callback(lambda future, id=id, user_id=user_id: self.completed.put((id, user_id, future)))
+            while not self.completed.empty():
+                self.handle(*self.completed.get())
+            if time.monotonic() - reported >= BROADCAST_PROGRESS_INTERVAL:
+                self.report()
+                reported = time.monotonic()
+        else:
+            finished = True
+        # Sends already queued are delivered and recorded even when stopping
+        while self.pending:
+            self.wait()
+        status = 'cancelled' if self.cancelled else 'done' if finished else 'running'
+        self.checkpoint(status)
+        self.report('paused' if status == 'running' else status)
+        logger.info(f'Broadcast {self.broadcast_id} {status}: {dict(self.counts)}')
+
+    def wait(self) -> None:
+        try:
+            self.handle(*self.completed.get(timeout=BROADCAST_PROGRESS_INTERVAL))
+        except Empty:
+            # Stuck behind a flood wait, keep the lease and the admins posted
+            self.checkpoint()
+            self.report()
+
+    def handle(self, id: int, user_id: int, future: Future) -> None:
+        self.pending.discard(id)
+        self.done.add(id)
+        e = future.exception()
+        if e is None:
+            self.counts['sent'] += 1
+        elif isinstance(e, Unauthorized) or (isinstance(e, BadRequest) and 'chat not found' in str(e).lower()):
+            self.counts['blocked'] += 1
+            set_user_blocked(user_id, True)
+        else:
+            self.counts['failed'] += 1
+        metrics.inc('broadcast_messages_total', outcome='sent' if e is None else 'failed')
+        self.checkpoint()
+
+    def checkpoint(self, status: str = 'running') -> None:
+        # Recipients are sent in id order, so everything below the oldest pending one is handled
+        last_id = min(self.pending) - 1 if self.pending else self.last_id
+        self.done = {id for id in self.done if id > last_id}
+        with session_scope() as session:
+            updated = session.query(Broadcast).filter(Broadcast.id == self.broadcast_id, Broadcast.status.in_({'running', status})).update({
+                Broadcast.status: status,
+                Broadcast.last_id: last_id,
+                Broadcast.done_ids: json.dumps(sorted(self.done)),
+                Broadcast.sent: self.counts['sent'],
+                Broadcast.failed: self.counts['failed'],
+                Broadcast.blocked: self.counts['blocked'],
+            }, synchronize_session=False)
+        if not updated and not self.stopping:
+            # Cancelled from another process
+            self.stopping = self.cancelled = True
+
+    def report(self, status: str = 'running') -> None:
+        handled = sum(self.counts.values())
+        rate = (handled - self.handled_before) / max(time.monotonic() - self.started, 1e-9)
+        if status == 'running':
+            eta = timedelta(seconds=int(max(0, self.total - handled) / rate)) if rate else '计算中'
+            state = f'速度：{rate:.1f}条/秒\n预计剩余时间：{eta}'
+        else:
+            state = {'done': '✅群发完成', 'cancelled': '⛔️群发已取消', 'paused': '⏸群发已暂停，稍后继续'}[status]
+        text_message = f'📣群发 #{self.broadcast_id}\n进度：{handled}/{self.total}\n成功：{self.counts["sent"]}\n失败：{self.counts["failed"]}\n已屏蔽机器人：{self.counts["blocked"]}\n{state}'
+        if self.progress_message_id:
+            outbox.edit_message_text(bot_metadata.admin_group.id, self.progress_message_id, text_message)
+        elif not self.progress_posting:
+            # Later reports edit the message once it is posted
+            self.progress_posting = True
+            future = outbox.send_message(bot_metadata.admin_group.id, text_message, priority=PRIORITY_ADMIN)
+            future.add_done_callback(self.store_progress_message_id)
+
+    def store_progress_message_id(self, future: Future) -> None:
+        self.progress_posting = False
+        if future.exception() or not future.result():
+            return
+        self.progress_message_id = future.result().message_id
+        with session_scope() as session:
+            session.query(Broadcast).filter_by(id=self.broadcast_id).update({Broadcast.progress_message_id: self.progress_message_id}, synchronize_session=False)
+
+    def stop(self, cancel: bool = False) -> None:
+        self.cancelled = self.cancelled or cancel
+        self.stopping = True
+
+broadcaster = None
+broadcaster_lock = threading.Lock()
+
+def start_broadcaster(broadcast_id: int) -> None:
+    global broadcaster
+    with broadcaster_lock:
+        broadcaster = Broadcaster(broadcast_id)
+        broadcaster.start()
+
+def resume_broadcasts() -> None:
+    """Pick up a running broadcast whose process stopped checkpointing for BROADCAST_LEASE seconds."""
+    if broadcaster and broadcaster.is_alive():
+        return
+    with session_scope() as session:
+        # The row lock makes concurrent replicas agree on a single taker
+        broadcast = session.query(Broadcast).filter_by(status='running').order_by(Broadcast.id).with_for_update().first()
+        if broadcast is None:
+            return
+        idle = session.query(func.now()).scalar() - broadcast.updated_at
+        if idle.total_seconds() < BROADCAST_LEASE:
+            return
+        broadcast.updated_at = func.now()
+        broadcast_id = broadcast.id
+    logger.info(f'Resuming broadcast {broadcast_id}')
+    start_broadcaster(broadcast_id)
+
+def stop_broadcaster(timeout: float = 30) -> None:
+    """Stop submitting sends, the broadcast stays running for the next process to resume."""
+    if broadcaster and broadcaster.is_alive():
+        broadcaster.stop()
+        broadcaster.join(timeout)
+
+def broadcast(update: Update, context: CallbackContext) -> None:
+    """/broadcast [all|subscribed|wish|nowallet] <message>, HTML formatting is kept.
+
+    A first word naming an audience is always taken as the audience.
+    """
+    if update.effective_user.id not in admins:
+        reply(update, '你没有权限使用此功能')
+        return
+    message = (update.message.text_html.split(None, 1) + [''])[1]
+    audience = 'all'
+    words = message.split(None, 1)
+    if words and words[0] in BROADCAST_AUDIENCES:
+        audience, message = words[0], words[1] if len(words) > 1 else ''
+    if not message.strip():
+        reply(update, f'用法：/broadcast [{"|".join(BROADCAST_AUDIENCES)}] 消息内容')
+        return
+    with session_scope() as session:
+        running = session.query(Broadcast.id).filter_by(status='running').first()
+        if running:
+            reply(update, f'群发 #{running.id} 正在进行，请等待完成或使用 /broadcast_cancel 取消')
+            return
+        total = session.query(func.count(User.id)).filter(*broadcast_audience_filter(audience)).scalar()
+        record = Broadcast(message=message, audience=audience, total=total)
+        session.add(record)
+        session.flush()
+        broadcast_id = record.id
+    reply(update, f'群发 #{broadcast_id} 已开始，共 {total} 位{BROADCAST_AUDIENCE_NAMES[audience]}')
+    start_broadcaster(broadcast_id)
+
+def broadcast_cancel(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in admins:
+        reply(update, '你没有权限使用此功能')
+        return
+    with session_scope() as session:
+        cancelled = session.query(Broadcast).filter_by(status='running').update({Broadcast.status: 'cancelled'}, synchronize_session=False)
+    if broadcaster and broadcaster.is_alive():
+        broadcaster.stop(cancel=True)
+    reply(update, '群发已取消' if cancelled else '没有正在进行的群发')
+
+# Exports of wishes, wallets and invite stats
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_FIELDS = (
+    'user_id', 'username', 'name', 'status', 'wish', 'wish_date', 'wish_claimed', 'wallet_address', 'is_subscribed',
+    'invitees_count', 'invitees_subscribed_count', 'invitees_subscribed_rate', 'invitees_wish_count', 'invitees_wish_rate',
+)
+
+def export_rows(since=None, until=None, claimed=None):
+    """Yield every user matching the filters as a dict of EXPORT_FIELDS.
+
+    Users are read in keyset pages of EXPORT_BATCH_SIZE on users.id, and each page's invitee
+    stats come from one aggregate over only that page's inviters. Memory stays bounded by
+    the page size even though mysqlconnector buffers every result set it reads.
+    since and until are inclusive dates on wish_date.
+    """
+    conditions = []
+    if since:
+        conditions.append(User.wish_date >= since)
+    if until:
+        conditions.append(User.wish_date < until + timedelta(days=1))
+    if claimed is not None:
+        conditions.append(User.wish_claimed == True if claimed else User.wish_claimed.isnot(True))
+    after_id = 0
+    while True:
+        with engine.connect() as connection:
+            users = connection.execute(
+                select(User.id, User.user_id, User.username, User.name, User.status, User.wish, User.wish_date, User.wish_claimed, User.wallet_address, User.is_subscribed)
+                .where(User.id > after_id, *conditions)
+                .order_by(User.id)
+                .limit(EXPORT_BATCH_SIZE)
+            ).all()
+            inviters = [user.user_id for user in users if user.user_id is not None]
+            stats = {row.user_id: row for row in connection.execute(select(invitee_stats_subquery(inviters)))} if inviters else {}
+        for user in users:
+            row = dict(user._mapping)
+            del row['id']
+            invitees = stats.get(user.user_id)
+            row['invitees_count'] = int(invitees.invitees) if invitees else 0
+            for name, column in (('subscribed', 'subscribed'), ('wish', 'wishes')):
+                count = row[f'invitees_{name}_count'] = int(getattr(invitees, column) or 0) if invitees else 0
+                row[f'invitees_{name}_rate'] = round(count / row['invitees_count'], 4) if row['invitees_count'] else 0
+            yield row
+        if len(users) < EXPORT_BATCH_SIZE:
+            return
+        after_id = users[-1].id
+
+def export_users(path: str, format: str = 'csv', **filters) -> int:
+    """Write the export to path as gzip compressed CSV or JSONL one row at a time, returning the row count."""
+    rows = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        if format == 'csv':
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for row in export_rows(**filters):
+            if format == 'csv':
+                writer.writerow(row)
+            else:
+                f.write(json.dumps({name: row[name] for name in EXPORT_FIELDS}, ensure_ascii=False, default=str) + '\n')
+            rows += 1
+    return rows
+
+def send_document(chat_id, path: str, **kwargs):
+    # Reopened on every attempt, the outbox may retry the upload
+    with open(path, 'rb') as document:
+        return bot.send_document(chat_id=chat_id, document=document, filename=os.path.basename(path), **kwargs)
+
+def parse_export_args(args: list) -> dict:
+    """Parse [csv|jsonl] [claimed|unclaimed] [YYYY-MM-DD [YYYY-MM-DD]] in any order."""
+    options = {'format': 'csv', 'since': None, 'until': None, 'claimed': None}
+    dates = []
+    for arg in args:
+        if arg in EXPORT_FORMATS:
+            options['format'] = arg
+        elif arg in ('claimed', 'unclaimed'):
+            options['claimed'] = arg == 'claimed'
+        else:
+            dates.append(datetime.strptime(arg, '%Y-%m-%d'))
+    if len(dates) > 2:
+        raise ValueError('too many dates')
+    options['since'], options['until'] = (dates + [None, None])[:2]
+    return options
+
+def run_export(options: dict, chat_id) -> None:
+    """Build the export file and post it to chat_id as a document, the file is removed once sent."""
+    format = options.pop('format')
+    started = time.perf_counter()
+    f = tempfile.NamedTemporaryFile(prefix=f'users-{datetime.now():%Y%m%d-%H%M}-', suffix=f'.{format}.gz', delete=False)
+    f.close()
+    try:
+        rows = export_users(f.name, format, **options)
     except Exception as e:
         logger.exception(e)
-        return False
-
-def format_poem_vertically_with_side_decorations_and_spacing(poem, spacing=1):
-    # Define punctuation
-    punctuation = "，、。！？；：「」『』（）《》【】"
+        os.remove(f.name)
+        outbox.send_message(chat_id, '导出失败', priority=PRIORITY_ADMIN)
+        return
+    logger.info(f'Exported {rows} users to {f.name} in {time.perf_counter() - started:.1f}s')
+    future = outbox.submit(chat_id, send_document, PRIORITY_ADMIN, path=f.name, caption=f'共 {rows} 位用户')
+    future.add_done_callback(lambda future: os.remove(f.name))
+
+def export(update: Update, context: CallbackContext) -> None:
+    """/export [csv|jsonl] [claimed|unclaimed] [from] [to], the file goes to the admin group."""
+    if update.effective_user.id not in admins:
+        reply(update, '你没有权限使用此功能')
+        return
+    try:
+        options = parse_export_args(context.args)
+    except ValueError:
+        reply(update, '用法：/export [csv|jsonl] [claimed|unclaimed] [开始日期 YYYY-MM-DD] [结束日期 YYYY-MM-DD]')
+        return
+    reply(update, '正在导出，完成后将发送到管理群')
+    # Large tables take a while, keep the dispatcher worker free
+    threading.Thread(target=run_export, args=(options, bot_metadata.admin_group.id), name='export', daemon=True).start()
 
-    # Find the length of the first line before any punctuation
-    first_line_length = next((i for i, char in enumerate(poem) if char in punctuation), len(poem))
+def log_cache_stats() -> None:
+    logger.info(f'Subscription cache: {subscription_cache.stats()}, user cache: {user_cache.stats()}')
 
-    # Calculate column_height
-    column_height = first_line_length
+def log_metrics() -> None:
+    logger.info(f'Last {METRICS_LOG_INTERVAL}s: {metrics.summary()}')
 
-    # Remove punctuation
-    for p in punctuation:
-        poem = poem.replace(p, "")
+POEM_PUNCTUATION = "，、。！？；：「」『』（）《》【】"
+POEM_PUNCTUATION_TABLE = str.maketrans('', '', POEM_PUNCTUATION)
+FIRST_POEM_PUNCTUATION = re.compile(f'[{re.escape(POEM_PUNCTUATION)}]')
 
-    # Calculate the number of characters and columns
-    num_chars = len(poem)
-    num_columns = -(-num_chars // column_height)
+def format_poem_vertically_with_side_decorations_and_spacing(poem, spacing=1):
+    # The first line, up to any punctuation, sets the column height
+    first_punctuation = FIRST_POEM_PUNCTUATION.search(poem)
+    column_height = max(1, first_punctuation.start() if first_punctuation else len(poem))
 
-    # Initialize the grid with full-width spaces
-    grid = [['\u3000' for _ in range(num_columns)] for _ in range(column_height)]
+    # Remove punctuation in one pass
+    poem = poem.translate(POEM_PUNCTUATION_TABLE)
+    num_columns = -(-len(poem) // column_height)
 
-    # Fill the grid with characters
+    # Fill the grid right to left, padded with full-width spaces
+    grid = [['\u3000'] * num_columns for _ in range(column_height)]
     for i, char in enumerate(poem):
-        col = num_columns - 1 - i // column_height
-        row = i % column_height
-        grid[row][col] = char
-
-    # Add spacing between lines and add lanterns to the left and right
-    space = '\u3000' * spacing  # Use full-width space for spacing
-    formatted_poem_lines_with_decor = [
-        '🏮' + space.join(row) + '🏮' for row in grid
-    ]
+        grid[i % column_height][num_columns - 1 - i // column_height] = char
 
-    # Combine everything into one string
-    formatted_poem_with_side_decor = '\n'.join(formatted_poem_lines_with_decor)
+    # Full-width spacing between columns and lanterns on both sides
+    space = '\u3000' * spacing
+    return '\n'.join('🏮' + space.join(row) + '🏮' for row in grid)
 
-    return formatted_poem_with_side_decor
+class PoemCache:
+    """Welcome poems read from a JSON list of strings, pre-rendered for every spacing.
+
+    load() is cheap when the file is unchanged. A changed file is rendered in full and
+    swapped in at once; a broken one is logged and the poems already loaded stay in use.
+    """
+    SPACINGS = range(4)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        # spacing -> tuple of Markdown messages
+        self.rendered = {}
+
+    def load(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            with open(self.path, encoding='utf-8') as f:
+                poems = json.load(f)
+            if not isinstance(poems, list) or not poems or not all(isinstance(poem, str) and poem for poem in poems):
+                raise ValueError('expected a non-empty list of poems')
+            rendered = {spacing: tuple(f'*{format_poem_vertically_with_side_decorations_and_spacing(poem, spacing)}*' for poem in poems) for spacing in self.SPACINGS}
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not load poems from {self.path}, keeping {len(self.rendered.get(0, ()))} loaded: {e}')
+            return False
+        self.rendered, self.mtime = rendered, mtime
+        logger.info(f'Loaded {len(poems)} poems from {self.path}')
+        return True
+
+    def choice(self, spacing: int = POEM_SPACING):
+        """A random rendered poem, None before any poem was loaded."""
+        poems = self.rendered.get(spacing)
+        return random.choice(poems) if poems else None
+
+poem_cache = PoemCache(POEMS_FILE)
 
 def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     user_name = update.effective_user.full_name
     username = update.effective_user.username
 
-    invite_user_id = None
-    if context.args:
-        invite_link_args = context.args[0]
-        if '_' in invite_link_args:
-            invite_user_id, _ = invite_link_args.split('_')
+    # Validated before any database work, forged links are treated as a plain /start
+    invite_user_id = parse_invite_payload(context.args[0]) if context.args else None
+    if invite_user_id == user_id:
+        invite_user_id = None
 
     with session_scope() as session:
-        existing_user = session.query(User).filter_by(user_id=user_id).first()
+        existing_user = get_user(session, user_id)
 
         # Check if the user is a member of the channel
-        is_subscribed = False
-        try:
-            member = context.bot.get_chat_member(chat_id=os.getenv('CHANNEL_NAME'), user_id=user_id)
-            if member.status not in ['left', 'kicked']:
-                is_subscribed = True
-        except BadRequest:
-            pass
+        is_subscribed = is_user_subscribed(user_id)
 
         if existing_user:
             add_user_to_db(user_id=user_id, name=user_name, username=username, status=existing_user.status, is_subscribed=is_subscribed)
@@ -457,82 +2748,633 @@ def start(update: Update, context: CallbackContext) -> None:
             add_user_to_db(user_id=user_id, name=user_name, username=username, is_subscribed=is_subscribed)
             if not is_subscribed:
                 message, reply_markup = subscribe_channel_message(True)
-                update.message.reply_text(message, reply_markup=reply_markup)
+                reply(update, message, reply_markup=reply_markup)
             else:
-                update.message.reply_text('📣恭喜，您的帐号创建成功！')
+                reply(update, '📣恭喜，您的帐号创建成功！')
 
         if invite_user_id:
-            invite_user = session.query(User).filter_by(user_id=invite_user_id).first()
-            if invite_user and invite_user.user_id != user_id:
-                # check if the user has already been invited
-                existing_invite = session.query(Invite).filter_by(user_id=invite_user_id, invitee_id=user_id).first()
-                if not existing_invite:
-                    invite = Invite(user_id=invite_user_id, invitee_id=user_id)
-                    invite_user.invitees_count += 1
-                    session.add(invite)
-                    session.commit()
-                    invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate = get_invitees_stats(invite_user_id)
-                    send_group_message(invite_user_id, invitees_subscribed_count, invitees_subscribed_rate, invitees_wish_count, invitees_wish_rate)
+            invite_user = get_user(session, invite_user_id)
+            if invite_user:
+                if record_invite(session, invite_user.user_id, user_id, is_subscribed, bool(existing_user and existing_user.wish)):
+                    mark_dashboard_dirty(invite_user.user_id)
                 else:
-                    bot.send_message(chat_id=user_id, text=f'你已经被邀请过了')
+                    outbox.send_message(user_id, '你已经被邀请过了')
 
     if user_id in admins:
-        update.message.reply_text('欢迎管理员!', reply_markup=get_keyboard(admin=True))
+        reply(update, '欢迎管理员!', reply_markup=get_keyboard(admin=True))
     else:
-        # Selected lines from the poems
-        poem_lines = [
-                    "元宵佳节到，请你吃元宵，香甜满心间，新春人更俏。",
-                    "正月十五良宵到，花灯吐艳把春报；一年初望明月照，汤圆滚烫闹良宵。",
-                    "元宵喜庆乐盈盈，大伙开心闹元宵，大街小巷人气旺 ，开开心心过元宵！",
-                    "元宵佳节明月圆，人间欢乐丰收年，花灯照亮好前景，日子幸福比蜜甜，健康快乐身体好，万事如意随心愿。",
-                    "元宵节来吃汤圆，吃碗汤圆心甜甜；幸福汤圆一入口，健康快乐常陪伴；爱情汤圆一入口，心如细丝甜如蜜；金钱汤圆一入口，财源滚滚斩不断！",
-                    "天上繁星晶晶亮，地上彩灯换色彩；天上明月寄相思，地上汤圆寄团圆；又逢一年元宵节，温馨祝福送心田；健康吉祥送给你，愿你梦想都实现。",
-                    "月儿圆圆挂枝头，元宵圆圆入你口，又是元宵佳节到，吃颗元宵开口笑，笑笑烦恼都跑掉，一生好运围你绕，事事顺利真美妙，元宵佳节乐逍遥！",
-                    "正月十五赏花灯，祝你心情亮如灯；正月十五吃汤圆，祝你阖家喜团圆；正月十五元宵香，祝你身体更健康；正月十五喜连连，祝你万事皆吉祥。",
-                    "正月十五闹花灯，焰火惊艳添福运；舞龙舞狮普天庆，且看且叹不须停；热火朝天贺元宵，万家团圆福气绕；祥瑞扑面跟你跑，幸福日子更美好！",
-                    "正月十五月儿圆，美好祝福在耳边；正月十五元宵甜，祝你今年更有钱；正月十五汤圆香，祝你身体更健康；正月十五乐团圆，祝你元宵乐连连！",
-                    "正月十五月儿圆，真诚祝福送身边；正月十五元宵甜，祝你龙年更有钱；正月十五展笑颜，快乐长久幸福绵；正月十五享团圆，祝你吉祥在龙年！",
-                    "车如流水马如龙，相约赏灯乐融融；金狮涌动舞不停，猜中灯谜笑盈盈；皎皎明月泻清辉，颗颗汤圆情意随；元宵佳节已然到，愿你开怀乐淘淘。",
-                    "春风阵阵佳节到，元宵灯会真热闹；四面八方人如潮，欢声笑语声声高；亲朋好友祝福绕，开开心心活到老；祝你佳节好运罩，万事顺利人欢笑！",
-                    "鱼跃龙门好有福，元宵佳节早送福；大福小福全家福，有福享福处处福；知福来福有祝福，清福鸿福添幸福；接福纳福年年福，守福祈福岁岁福！",
-                    "元宵佳节明月升，嫦娥曼舞看清影，元宵香从圆月来，高歌一曲赏美景，亲友团圆叙旧情，一缕相思圆月中，团圆之夜思绪浓，共用快乐互叮咛。",
-                    "一元复苏大地春，正月十五闹元宵。圆月高照星空灿，灯火辉煌闹春年。万家灯火歌声扬，团团圆圆品汤圆，其乐融融笑声甜，幸福滋味香飘然。",
-                    "元宵圆圆盘中盛，举家投著来品尝。颗颗润滑甜如蜜，团圆之情入心底。彩灯纷纷空中挂，亲友相约赏灯忙。灯火通明好年景，万千喜悦心中放。",
-                    "唢呐声声人欢笑，张灯结彩闹元宵。明月花灯两相照，龙狮飞舞热情高。烟花爆竹绽笑颜，剪纸窗花美无边。一碗汤圆香又甜，万千祝福润心田。",
-                    "点点元宵似珍珠，用心品尝香无数。一个元宵千般情，愿你天天好心情。展展花灯美无边，流连忘返人群间。一个花灯万般愿，愿你生活比蜜甜。",
-                    "元宵佳节闹花灯，一份祝福藏其中。明月皎皎人团圆，汤圆香甜爱情甜。红灯高照事业旺，美酒醇厚阖家康。愿你元宵乐连连，开心幸福绽笑颜。",
-                    "正月十五月儿圆，元宵佳节喜庆多，心情愉快朋友多，身体健康快乐多，财源滚滚钞票多，全家团圆幸福多，年年吉祥如意多，岁岁平安多好事！",
-                    "杨柳轻扬春意早，十里长街闹元宵。扭动腰肢挑花灯，耄耋童子齐欢笑。糯米揉团蜜馅包，团团圆圆吃到饱。叙过家常侃大山，大家一起乐元宵。"
-                ]
-
-        random_line = random.choice(poem_lines)
-
-        message = format_poem_vertically_with_side_decorations_and_spacing(random_line, spacing=2)
-
-        italicized_random_line = f"*{message}*"
-        # Prepare the welcome message with the italicized poem line
-        welcome_message_1 = italicized_random_line
+        # The poem greeting is the first thing dropped under overload
+        message = None if load_shedder.overloaded() else poem_cache.choice()
+        if message:
+            reply(update, message, parse_mode=ParseMode.MARKDOWN, reply_markup=get_link_keyboard_button())
         welcome_message_2 = f'欢迎参加🏮元宵节花灯庆祝活动！祝你🏮元宵节快乐！'
-        update.message.reply_text(welcome_message_1, parse_mode=ParseMode.MARKDOWN,
-        reply_markup=get_link_keyboard_button())
-        update.message.reply_text(welcome_message_2, reply_markup=get_keyboard())
+        reply(update, welcome_message_2, reply_markup=get_keyboard())
+
+USER_DATA = 'user_data'
+
+class DatabasePersistence(BasePersistence):
+    """Keeps ConversationHandler states and user_data in the conversation_states table.
+
+    Reads are served from memory. A user's rows are loaded before handling their first
+    update and then kept, for up to PERSISTENCE_CACHE_SIZE users. Writes are kept in
+    memory and upserted in one batch by sync() every PERSISTENCE_FLUSH_INTERVAL, which
+    then reads back the rows changed since its last run with one range scan of
+    updated_at, so state written by another replica shows up within that interval
+    without a query per update. Values have to be JSON serializable.
+    """
+
+    def __init__(self):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.user_data = defaultdict(dict)
+        self.conversations = {}
+        self.loaded = TTLCache(float('inf'), PERSISTENCE_CACHE_SIZE)
+        # Database time of the newest row read back by poll()
+        self.polled_at = None
+        # (kind, key) -> (user_id, data) not yet written, and the user_data last seen in the table
+        self.pending = {}
+        self.saved_user_data = {}
+        self.flushes = 0
+        self.last_flushed_users = set()
+        self.lock = threading.Lock()
+
+    # Nothing JSON serializable can hold a Bot, skip the deep copies made to swap it in and out
+    def insert_bot(self, obj):
+        return obj
+
+    def replace_bot(self, obj):
+        return obj
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return self.conversations.setdefault(name, {})
+
+    def update_conversation(self, name, key, new_state) -> None:
+        data = json.dumps(new_state) if new_state is not None else None
+        with self.lock:
+            self.pending[(name, json.dumps(key))] = (key[-1], data)
+
+    def update_user_data(self, user_id, data) -> None:
+        # Called after every update, only changed user_data is written
+        data = json.dumps(data) if data else None
+        with self.lock:
+            if self.saved_user_data.get(user_id) == data:
+                return
+            self.saved_user_data[user_id] = data
+            self.pending[(USER_DATA, str(user_id))] = (user_id, data)
+
+    def update_chat_data(self, chat_id, data) -> None:
+        pass
+
+    def update_bot_data(self, data) -> None:
+        pass
+
+    def refresh(self, user_id) -> None:
+        """Reload a user's conversation states and user_data unless they are fresh in memory."""
+        if self.loaded.get(user_id):
+            return
+        flushes = self.flushes
+        with session_scope() as session:
+            rows = session.query(ConversationState.kind, ConversationState.key, ConversationState.data).filter_by(user_id=user_id).all()
+        with self.lock:
+            if self.flushes > flushes + 1 or (self.flushes != flushes and user_id in self.last_flushed_users):
+                # Rows may predate a write that was just flushed, reload on the next update
+                return
+            self.apply(rows, user_id)
+        self.loaded.set(user_id, True)
+
+    def apply(self, rows, user_id) -> None:
+        # Called with the lock held, writes still pending here are newer
+        for kind, key, data in rows:
+            if (kind, key) in self.pending:
+                continue
+            if kind == USER_DATA:
+                self.user_data[user_id] = json.loads(data) if data else {}
+                self.saved_user_data[user_id] = data
+            elif kind in self.conversations:
+                if data is None:
+                    self.conversations[kind].pop(tuple(json.loads(key)), None)
+                else:
+                    self.conversations[kind][tuple(json.loads(key))] = json.loads(data)
 
-def main() -> None:
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(bot=bot, use_context=True)
+    def sync(self) -> None:
+        self.flush()
+        self.poll()
+
+    def poll(self) -> None:
+        """Apply rows written since the last poll, by any process, to the users held in memory."""
+        flushes = self.flushes
+        with session_scope() as session:
+            if self.polled_at is None:
+                self.polled_at = session.query(func.now()).scalar()
+                return
+            # updated_at has second resolution and commits trail it, overlap the last window
+            rows = session.query(ConversationState.kind, ConversationState.key, ConversationState.user_id, ConversationState.data, ConversationState.updated_at).filter(ConversationState.updated_at >= self.polled_at - timedelta(seconds=2)).all()
+        with self.lock:
+            if self.flushes != flushes:
+                # Rows may predate a write that was just flushed, read them again next time
+                return
+            by_user = defaultdict(list)
+            for kind, key, user_id, data, updated_at in rows:
+                self.polled_at = max(self.polled_at, updated_at)
+                if self.loaded.get(user_id):
+                    by_user[user_id].append((kind, key, data))
+            for user_id, user_rows in by_user.items():
+                self.apply(user_rows, user_id)
+
+    def flush(self) -> None:
+        """Write pending states and user_data with a single upsert."""
+        with self.lock:
+            pending = dict(self.pending)
+        if not pending:
+            return
+        statement = mysql_insert(ConversationState).values([
+            {'kind': kind, 'key': key, 'user_id': user_id, 'data': data}
+            for (kind, key), (user_id, data) in pending.items()
+        ])
+        with session_scope() as session:
+            # onupdate defaults don't apply to ON DUPLICATE KEY UPDATE, poll() relies on updated_at
+            session.execute(statement.on_duplicate_key_update(user_id=statement.inserted.user_id, data=statement.inserted.data, updated_at=func.now()))
+        with self.lock:
+            # Keep entries that changed again while writing for the next flush
+            for item_key, value in pending.items():
+                if self.pending.get(item_key) is value:
+                    del self.pending[item_key]
+            self.flushes += 1
+            self.last_flushed_users = {user_id for user_id, _ in pending.values()}
+        logger.debug(f'Flushed {len(pending)} conversation states')
+
+persistence = DatabasePersistence()
+
+ALLOWED_UPDATES = ['message', 'edited_message', 'callback_query', 'chat_member', 'my_chat_member']
+
+class FloodControl:
+    """Per-user token buckets, also merging repeats of the same message into the first.
+
+    A user's state is one tuple in an OrderedDict kept in last-seen order. Users idle
+    long enough for their bucket to refill are evicted from the front, so memory only
+    grows with the users active in the last few seconds.
+    """
+
+    def __init__(self, rate: float, burst: float, duplicate_window: float):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.idle = max(burst / rate, duplicate_window)
+        self.users = OrderedDict()  # user_id -> (tokens, updated, last message hash, last message time)
+        self.lock = threading.Lock()
+
+    def check(self, user_id: int, message_hash) -> str:
+        """None when the update may pass, otherwise why it is dropped."""
+        now = time.monotonic()
+        with self.lock:
+            while self.users:
+                oldest = next(iter(self.users.values()))
+                if now - oldest[1] < self.idle:
+                    break
+                self.users.popitem(last=False)
+            state = self.users.pop(user_id, None)
+            if state is None:
+                tokens, last_hash, last_at = self.burst, None, 0.0
+            else:
+                tokens, updated, last_hash, last_at = state
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if message_hash is not None and message_hash == last_hash and now - last_at < self.duplicate_window:
+                verdict = 'duplicate'
+            elif tokens < 1:
+                verdict = 'rate_limited'
+            else:
+                verdict = None
+                tokens -= 1
+                last_hash, last_at = message_hash, now
+            self.users[user_id] = (tokens, now, last_hash, last_at)
+            return verdict
+
+class LoadShedder:
+    """Flags overload while the dispatch backlog or the recent p99 handling time is past its threshold."""
+
+    def __init__(self, queue_depth: int, p99: float):
+        self.queue_depth = queue_depth
+        self.p99 = p99
+        self.depth = lambda: 0  # set by create_app()
+        self.durations = deque(maxlen=500)
+        self.checked_at = 0.0
+        self.state = False
+
+    def observe(self, seconds: float) -> None:
+        self.durations.append(seconds)
+
+    def overloaded(self) -> bool:
+        now = time.monotonic()
+        if now - self.checked_at >= 1:
+            self.checked_at = now
+            durations = sorted(self.durations)
+            p99 = durations[int(len(durations) * 0.99)] if durations else 0.0
+            depth = self.depth()
+            state = bool(self.queue_depth and depth >= self.queue_depth) or bool(self.p99 and p99 >= self.p99)
+            if state != self.state:
+                logger.warning(f'{"Entering" if state else "Leaving"} overload mode, queue depth {depth}, p99 {p99:.3f}s')
+                self.state = state
+        return self.state
+
+flood_control = FloodControl(USER_RATE_LIMIT or 1, USER_RATE_BURST, USER_DUPLICATE_WINDOW)
+load_shedder = LoadShedder(OVERLOAD_QUEUE_DEPTH, OVERLOAD_P99)
+
+# Button presses and commands that only read, shed first under overload
+LOW_PRIORITY_MESSAGES = {'🥣我的邀请'}
+LOW_PRIORITY_COMMANDS = {'leaderboard'}
+
+def is_low_priority(message) -> bool:
+    """Whether a message is a read-only button press or command, matching commands like CommandHandler."""
+    if message.text in LOW_PRIORITY_MESSAGES:
+        return True
+    entities = message.entities
+    if not message.text or not entities or entities[0].type != MessageEntity.BOT_COMMAND or entities[0].offset != 0:
+        return False
+    # /leaderboard, or /leaderboard@<botname> as sent in groups
+    command, _, username = message.text[1:entities[0].length].partition('@')
+    return command.lower() in LOW_PRIORITY_COMMANDS and (not username or username.lower() == bot_metadata.me.username.lower())
+
+def admit_update(update) -> bool:
+    """Decide in front of the dispatcher whether a user's message gets handled at all."""
+    if not isinstance(update, Update) or not update.message or not update.effective_user:
+        return True
+    if update.effective_user.id in admins:
+        return True
+    if is_low_priority(update.message) and load_shedder.overloaded():
+        metrics.inc('updates_dropped_total', reason='overload')
+        return False
+    if update.effective_chat.type != Chat.PRIVATE:
+        return True
+    text = update.message.text
+    if USER_RATE_LIMIT:
+        verdict = flood_control.check(update.effective_user.id, hash(text) if text else None)
+        if verdict:
+            metrics.inc('updates_dropped_total', reason=verdict)
+            return False
+    return True
+
+class UnitOfWorkDispatcher(Dispatcher):
+    """Dispatcher that handles each update inside a single database session."""
+
+    def process_update(self, update) -> None:
+        if admit_update(update):
+            self.handle_update(update)
+
+    def handle_update(self, update) -> None:
+        with update_scope(update):
+            if isinstance(self.persistence, DatabasePersistence) and isinstance(update, Update) and update.effective_user:
+                self.persistence.refresh(update.effective_user.id)
+            super().process_update(update)
+
+    def dispatch_error(self, update, error, promise=None) -> None:
+        # Handler errors are swallowed by process_update, undo the failed handler's writes here
+        if getattr(db_context, 'session', None) is not None:
+            db_context.session.rollback()
+        super().dispatch_error(update, error, promise)
+
+# Tells a dispatch shard to exit, never a value an update queue can carry
+_STOP = object()
+
+class OrderedDispatcher(UnitOfWorkDispatcher):
+    """Dispatcher that handles updates of different users concurrently.
+
+    Updates are sharded by user onto a fixed pool of worker threads, each with its
+    own bounded queue, so updates of the same user are always processed in the order
+    they arrived and ConversationHandler state transitions stay consistent.
+    Putting into a full shard queue blocks the dispatcher loop, which in turn blocks
+    the bounded update queue and the poller feeding it.
+    """
+
+    def __init__(self, *args, shards: int = DISPATCH_WORKERS, shard_queue_size: int = DISPATCH_QUEUE_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_queues = [Queue(maxsize=shard_queue_size) for _ in range(shards)]
+        self.shard_threads = []
+
+    @staticmethod
+    def shard_key(update) -> int:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return 0
+
+    def start(self, ready=None) -> None:
+        if not self.shard_threads:
+            for i, shard_queue in enumerate(self.shard_queues):
+                thread = threading.Thread(target=self._run_shard, args=(shard_queue,), name=f'dispatch-shard-{i}', daemon=True)
+                thread.start()
+                self.shard_threads.append(thread)
+        super().start(ready)
+
+    def process_update(self, update) -> None:
+        if admit_update(update):
+            shard_queue = self.shard_queues[self.shard_key(update) % len(self.shard_queues)]
+            shard_queue.put(update)
+
+    def _run_shard(self, shard_queue: Queue) -> None:
+        while True:
+            update = shard_queue.get()
+            try:
+                if update is _STOP:
+                    break
+                self.handle_update(update)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                shard_queue.task_done()
+
+    def queue_depth(self) -> int:
+        return self.update_queue.qsize() + sum(q.qsize() for q in self.shard_queues)
+
+    def stop(self) -> None:
+        super().stop()
+        # Let the shards drain what they already accepted, then shut them down
+        for shard_queue in self.shard_queues:
+            shard_queue.put(_STOP)
+        for thread in self.shard_threads:
+            thread.join()
+        self.shard_threads = []
+
+def create_dispatcher() -> Dispatcher:
+    """Build the dispatcher, concurrent unless DISPATCH_WORKERS is set to 0."""
+    update_queue = Queue(maxsize=DISPATCH_QUEUE_SIZE)
+    if DISPATCH_WORKERS > 0:
+        return OrderedDispatcher(bot, update_queue, persistence=persistence, use_context=True)
+    return UnitOfWorkDispatcher(bot, update_queue, persistence=persistence, use_context=True)
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Accepts updates from Telegram and answers as soon as they are queued."""
+    server_version = 'LanternBot'
+
+    def log_message(self, format, *args) -> None:
+        logger.debug(f'{self.address_string()} {format % args}')
+
+    def respond(self, status: int, body: bytes = b'') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != '/healthz':
+            self.respond(404)
+        elif self.server.dispatcher.running:
+            self.respond(200, f'ok queue={self.server.dispatcher.update_queue.qsize()}'.encode())
+        else:
+            self.respond(503, b'dispatcher not running')
+
+    def do_POST(self) -> None:
+        if self.path != WEBHOOK_PATH:
+            self.respond(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            self.respond(403)
+            return
+        try:
+            data = json.loads(body)
+            # de_json returns None for an empty object, which must never reach the dispatcher
+            update = Update.de_json(data, bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            self.respond(400)
+            return
+        try:
+            self.server.dispatcher.update_queue.put(update, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except Full:
+            # Telegram redelivers updates that were not acknowledged
+            self.respond(503)
+            return
+        self.server.record(body)
+        self.respond(200)
+
+class WebhookServer(ThreadingHTTPServer):
+    """Local HTTP listener for webhook mode, serving WEBHOOK_PATH and /healthz."""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, dispatcher: Dispatcher, address=(WEBHOOK_LISTEN, WEBHOOK_PORT)):
+        super().__init__(address, WebhookRequestHandler)
+        self.dispatcher = dispatcher
+        self.thread = None
+        self.record_lock = threading.Lock()
+        self.record_file = open(WEBHOOK_RECORD_FILE, 'ab') if WEBHOOK_RECORD_FILE else None
+
+    def record(self, body: bytes) -> None:
+        if self.record_file:
+            with self.record_lock:
+                self.record_file.write(body.replace(b'\n', b'') + b'\n')
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+        self.thread.start()
+        logger.info(f'Webhook listening on {self.server_address[0]}:{self.server_address[1]}{WEBHOOK_PATH}')
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self.record_file:
+            self.record_file.close()
+
+def run_webhook(updater: Updater) -> None:
+    """Serve updates through the built-in webhook listener until SIGINT or SIGTERM."""
+    dispatcher = updater.dispatcher
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    server = WebhookServer(dispatcher)
+    server.start()
+    if WEBHOOK_URL:
+        bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            api_kwargs={'secret_token': WEBHOOK_SECRET},
+        )
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+    server.stop()
+    dispatcher.stop()
+
+class InstrumentedRequest(Request):
+    """Request that records the latency and errors of every Bot API call."""
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except TelegramError as e:
+            metrics.inc('bot_api_errors_total', method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('bot_api_request_seconds', time.perf_counter() - started, method=method)
+
+def timed_callback(callback):
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        finally:
+            metrics.observe('handler_duration_seconds', time.perf_counter() - started, handler=callback.__name__)
+    return wrapper
+
+def instrument_handlers(handlers) -> None:
+    """Time the callbacks of handlers, including those nested in conversations."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        elif not hasattr(handler.callback, '__wrapped__'):
+            handler.callback = timed_callback(handler.callback)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves metrics in the Prometheus text format on /metrics."""
+
+    def log_message(self, format, *args) -> None:
+        logger.debug(f'{self.address_string()} {format % args}')
+
+    def do_GET(self) -> None:
+        body = metrics.render().encode() if self.path == '/metrics' else b''
+        self.send_response(200 if body else 404)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server() -> None:
+    server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics')
+
+def init_db() -> None:
+    Base.metadata.create_all(engine)
+    migrate_schema()
+
+def schedule_jobs() -> None:
+    scheduler.add_job(flush_dashboard, 'interval', seconds=DASHBOARD_FLUSH_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(log_cache_stats, 'interval', minutes=10)
+    scheduler.add_job(log_metrics, 'interval', seconds=METRICS_LOG_INTERVAL)
+    scheduler.add_job(bot_metadata.refresh_in_background, 'interval', seconds=METADATA_REFRESH_INTERVAL)
+    scheduler.add_job(persistence.sync, 'interval', seconds=PERSISTENCE_FLUSH_INTERVAL, max_instances=1, coalesce=True)
+    if USER_CACHE_ENABLED:
+        scheduler.add_job(user_changes.poll, 'interval', seconds=USER_CACHE_SYNC_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(write_behind.flush, 'interval', seconds=WRITE_BEHIND_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(campaign_stats.flush, 'interval', seconds=STATS_FLUSH_INTERVAL, max_instances=1, coalesce=True)
+    # Also runs right away, seeding the rollups on the first start
+    scheduler.add_job(campaign_stats.reconcile, 'interval', seconds=STATS_RECONCILE_INTERVAL, max_instances=1, coalesce=True, next_run_time=datetime.now(pytz.utc))
+    if SUBSCRIPTION_SWEEP_INTERVAL:
+        scheduler.add_job(sweep_subscriptions, 'interval', seconds=SUBSCRIPTION_SWEEP_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(poem_cache.load, 'interval', seconds=POEMS_RELOAD_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(draw_pool.reload, 'interval', seconds=DRAW_POOL_RELOAD_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(invite_ranking.reload, 'interval', seconds=LEADERBOARD_RELOAD_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(resume_broadcasts, 'interval', seconds=BROADCAST_LEASE, max_instances=1, coalesce=True)
+
+def create_app() -> Updater:
+    """Create the bot, resolve its metadata, prepare the database and register handlers."""
+    global bot
+    request = InstrumentedRequest(con_pool_size=max(20, DISPATCH_WORKERS + 8))
+    bot = Bot(token=os.getenv('BOT_TOKEN'), base_url=BOT_API_URL, request=request)
+
+    # Chat metadata and the schema don't depend on each other
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        resolved = executor.submit(bot_metadata.resolve)
+        executor.submit(init_db).result()
+        resolved.result()
+    load_legacy_inviters()
+    # Start the change watermarks before any conversation state or user is cached
+    persistence.poll()
+    user_changes.poll()
+
+    poem_cache.load()
+    schedule_jobs()
+    scheduler.start()
+
+    # Create the Updater around a dispatcher with a bounded update queue
+    updater = Updater(dispatcher=create_dispatcher(), workers=None)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
     # Register command handlers
     dp.add_handler(CommandHandler("start", start))
+    dp.add_handler(CommandHandler("broadcast", broadcast))
+    dp.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel))
+    dp.add_handler(CommandHandler("draw", draw))
+    dp.add_handler(CommandHandler("leaderboard", leaderboard))
+    dp.add_handler(CommandHandler("export", export))
+    dp.add_handler(CommandHandler("stats", stats))
     dp.add_handler(MessageHandler(Filters.regex('^🥣我的邀请$'), get_my_invitees))
     dp.add_handler(make_wish_handler)
     dp.add_handler(bind_wallet_address_handler)
     dp.add_handler(wish_come_true_handler)
-    # Start the Bot
-    updater.start_polling()
-    updater.idle()
+    dp.add_handler(ChatMemberHandler(track_channel_members, ChatMemberHandler.ANY_CHAT_MEMBER))
+
+    instrument_handlers([handler for handlers in dp.handlers.values() for handler in handlers])
+    metrics.gauge('dispatcher_queue_depth', getattr(dp, 'queue_depth', dp.update_queue.qsize))
+    load_shedder.depth = getattr(dp, 'queue_depth', dp.update_queue.qsize)
+    metrics.gauge('overloaded', lambda: int(load_shedder.state))
+    metrics.gauge('outbox_pending', outbox.pending)
+    metrics.gauge('write_behind_pending', write_behind.pending)
+    metrics.gauge('broadcast_pending', lambda: len(broadcaster.pending) if broadcaster else 0)
+    if SLOW_UPDATE_PROFILE_THRESHOLD:
+        profiler.start()
+    return updater
+
+def main() -> None:
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        # Without it anyone who finds the endpoint can post updates
+        sys.exit('WEBHOOK_SECRET must be set in webhook mode')
+    updater = create_app()
+    outbox.start()
+    if METRICS_PORT:
+        start_metrics_server()
+    if BOT_MODE == 'webhook':
+        run_webhook(updater)
+    else:
+        # Start the Bot, chat_member updates have to be requested explicitly
+        updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        updater.idle()
+    # Deliver whatever the handlers queued before shutting down
+    scheduler.shutdown()
+    stop_broadcaster()
+    persistence.flush()
+    flush_dashboard()
+    write_behind.flush(wait=True)
+    campaign_stats.flush()
+    outbox.stop()
 
 if __name__ == '__main__':
-    main()#
\ No newline at end of file
+    if sys.argv[1:2] == ['reconcile-counters']:
+        # python main.py reconcile-counters [--fix]
+        print(f'{reconcile_invitee_counters(fix="--fix" in sys.argv)} users with drifted invitee counters')
+    elif sys.argv[1:2] == ['export']:
+        # python main.py export users.csv.gz [jsonl] [claimed|unclaimed] [from] [to]
+        parser = argparse.ArgumentParser(prog='main.py export')
+        parser.add_argument('path')
+        parser.add_argument('filters', nargs='*', help='csv|jsonl, claimed|unclaimed and up to two YYYY-MM-DD dates on wish_date')
+        args = parser.parse_args(sys.argv[2:])
+        try:
+            options = parse_export_args(args.filters)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f'{export_users(args.path, options.pop("format"), **options)} users exported to {args.path}')
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,59 @@
+"""Replay recorded updates against a running webhook listener and report ack latency.
+
+Record updates by starting the bot in webhook mode with WEBHOOK_RECORD_FILE set, then:
+
+    python replay_updates.py updates.jsonl --url http://127.0.0.1:8080/telegram --concurrency 16
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import argparse
+import os
+import time
+import urllib.error
+import urllib.request
+
+load_dotenv()
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def post_update(url, secret, body):
+    request = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('updates', help='JSONL file with one update per line')
+    parser.add_argument('--url', default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', 8080)}{os.getenv('WEBHOOK_PATH', '/telegram')}")
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=1, help='replay the file this many times')
+    args = parser.parse_args()
+
+    with open(args.updates, 'rb') as f:
+        bodies = [line.strip() for line in f if line.strip()] * args.repeat
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda body: post_update(args.url, args.secret, body), bodies))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for status, latency in results if status == 200]
+    failed = len(results) - len(latencies)
+    print(f'{len(results)} updates in {elapsed:.2f}s ({len(results) / elapsed:.1f} updates/s), {failed} not acknowledged')
+    print(f'ack latency p50={percentile(latencies, 50) * 1000:.1f}ms p95={percentile(latencies, 95) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""Unit tests of the pure-Python parts of main.py, no database or Telegram needed.
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from queue import Queue
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot, Update, User
+from telegram.error import RetryAfter
+
+import main
+
+def make_update(user_id: int, text: str = 'hi', update_id: int = 1, chat_id: int = None) -> Update:
+    chat_id = user_id if chat_id is None else chat_id
+    message = {
+        'message_id': update_id, 'date': 1700000000, 'text': text,
+        'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update.de_json({'update_id': update_id, 'message': message}, None)
+
+class AdmitUpdateTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(main.bot_metadata, 'me', User(123456, 'bot', True, username='Test_Bot')),
+            mock.patch.object(main, 'admins', [1]),
+            mock.patch.object(main, 'flood_control', main.FloodControl(1, 5, 2)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sheds_read_only_messages_under_overload(self):
+        shed = ['🥣我的邀请', '/leaderboard', '/leaderboard 2', '/LEADERBOARD', '/leaderboard@test_bot']
+        kept = ['/leaderboard@other_bot', '/start', 'leaderboard', '🏮写下愿望']
+        with mock.patch.object(main.load_shedder, 'overloaded', return_value=True):
+            for i, text in enumerate(shed + kept):
+                for chat_id in (None, -1002):
+                    with self.subTest(text=text, chat_id=chat_id):
+                        self.assertEqual(text in kept, main.admit_update(make_update(100 + i, text, chat_id=chat_id)))
+            self.assertTrue(main.admit_update(make_update(1, '/leaderboard')))
+        self.assertTrue(main.admit_update(make_update(200, '/leaderboard@Test_Bot', chat_id=-1002)))
+
+    def test_flood_control_applies_to_private_chats(self):
+        self.assertEqual([True] * 5 + [False], [main.admit_update(make_update(5, f'm{i}')) for i in range(6)])
+        self.assertTrue(main.admit_update(make_update(5, 'in a group', chat_id=-1002)))
+
+class FloodControlTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        flood_control = main.FloodControl(rate=1, burst=3, duplicate_window=2)
+        now = time.monotonic()
+        with mock.patch.object(time, 'monotonic', return_value=now):
+            self.assertEqual([None, None, None, 'rate_limited'], [flood_control.check(1, i) for i in range(4)])
+            self.assertIsNone(flood_control.check(2, 0))
+        with mock.patch.object(time, 'monotonic', return_value=now + 1):
+            self.assertEqual([None, 'rate_limited'], [flood_control.check(1, i) for i in range(10, 12)])
+
+    def test_duplicates_within_window(self):
+        flood_control = main.FloodControl(rate=10, burst=10, duplicate_window=2)
+        now = time.monotonic()
+        with mock.patch.object(time, 'monotonic', return_value=now):
+            self.assertIsNone(flood_control.check(1, 'hash'))
+            self.assertEqual('duplicate', flood_control.check(1, 'hash'))
+            self.assertIsNone(flood_control.check(1, None))
+            self.assertIsNone(flood_control.check(1, None))
+        with mock.patch.object(time, 'monotonic', return_value=now + 2.1):
+            self.assertIsNone(flood_control.check(1, 'hash'))
+
+    def test_idle_users_are_evicted(self):
+        flood_control = main.FloodControl(rate=1, burst=2, duplicate_window=1)
+        now = time.monotonic()
+        with mock.patch.object(time, 'monotonic', return_value=now):
+            for user_id in range(100):
+                flood_control.check(user_id, None)
+        with mock.patch.object(time, 'monotonic', return_value=now + 3):
+            flood_control.check(1000, None)
+        self.assertEqual([1000], list(flood_control.users))
+
+class RecordingDispatcher(main.OrderedDispatcher):
+    def __init__(self, **kwargs):
+        super().__init__(Bot('123456:test'), Queue(), **kwargs)
+        self.handled = []
+
+    def handle_update(self, update) -> None:
+        self.handled.append(update)
+
+    def start_shards(self) -> None:
+        for shard_queue in self.shard_queues:
+            thread = threading.Thread(target=self._run_shard, args=(shard_queue,), daemon=True)
+            thread.start()
+            self.shard_threads.append(thread)
+
+class TTLCacheTest(unittest.TestCase):
+    def test_expiry_and_lru(self):
+        cache = main.TTLCache(60, 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((1, None, 3), (cache.get('a'), cache.get('b'), cache.get('c')))
+        with mock.patch.object(time, 'monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+
+    def test_fill_older_than_a_write_is_dropped(self):
+        cache = main.TTLCache(60, 3)
+        generation = cache.generation
+        cache.pop('a')
+        cache.set('a', 'stale', generation=generation)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 'fresh', generation=cache.generation)
+        self.assertEqual('fresh', cache.get('a'))
+
+    def test_write_to_another_key_keeps_fill(self):
+        cache = main.TTLCache(60, 3)
+        generation = cache.generation
+        cache.pop('b')
+        cache.set('a', 1, generation=generation)
+        self.assertEqual(1, cache.get('a'))
+
+    def test_fill_older_than_forgotten_writes_is_dropped(self):
+        cache = main.TTLCache(60, 3)
+        generation = cache.generation
+        for key in 'cdef':
+            cache.pop(key)
+        cache.set('z', 1, generation=generation)
+        self.assertIsNone(cache.get('z'))
+        cache.clear()
+        cache.set('z', 1, generation=generation)
+        self.assertIsNone(cache.get('z'))
+
+class WeightIndexTest(unittest.TestCase):
+    def assert_samples_follow_weights(self, index, weights):
+        expected = [i for i, weight in enumerate(weights) for _ in range(weight)]
+        self.assertEqual(len(expected), index.total)
+        rng = mock.Mock()
+        for target, item in enumerate(expected):
+            rng.randrange.return_value = target
+            self.assertEqual(item, index.sample(rng))
+
+    def test_samples_cover_cumulative_ranges(self):
+        weights = [3, 0, 1, 5, 0, 0, 2, 1, 4]
+        self.assert_samples_follow_weights(main.WeightIndex(weights), weights)
+
+    def test_set_and_remove(self):
+        weights = [1, 2, 3, 4, 5, 6, 7]
+        index = main.WeightIndex(weights)
+        index.set(2, 10)
+        index.remove(5)
+        index.remove(0)
+        weights[2], weights[5], weights[0] = 10, 0, 0
+        self.assertEqual(weights, index.weights)
+        self.assert_samples_follow_weights(index, weights)
+
+    def test_seeded_sampling_is_reproducible(self):
+        index = main.WeightIndex(range(50))
+        self.assertEqual([index.sample(main.random.Random(7)) for _ in range(5)], [index.sample(main.random.Random(7)) for _ in range(5)])
+
+class DrawPoolTest(unittest.TestCase):
+    def test_assign_grows_and_tracks_users(self):
+        pool = main.DrawPool()
+        pool.assign(3, 300, 2)
+        pool.assign(10, 1000, 1)
+        self.assertGreaterEqual(pool.index.size, 11)
+        self.assertEqual(3, pool.index.total)
+        self.assertEqual({3: 300, 10: 1000}, pool.user_ids)
+        self.assertEqual({300: 3, 1000: 10}, pool.ids)
+        pool.assign(3, 300, 0)
+        self.assertEqual(1, pool.index.total)
+        self.assertEqual({10: 1000}, pool.user_ids)
+        self.assertEqual({1000: 10}, pool.ids)
+
+    def test_changes_are_ignored_until_tracking(self):
+        pool = main.DrawPool()
+        pool.mark_stale([1, 2])
+        self.assertEqual(set(), pool.stale)
+        pool.tracking = True
+        pool.mark_stale([1, 2])
+        self.assertEqual({1, 2}, pool.stale)
+
+class BotMetadataTest(unittest.TestCase):
+    def test_cached_identity_spares_get_me(self):
+        chats = {'admin_group': '-1001', 'group': '-1002', 'channel': '@channel'}
+        data = {
+            'token_id': '123456', 'chat_ids': chats,
+            'me': {'id': 123456, 'is_bot': True, 'first_name': 'bot', 'username': 'test_bot'},
+            **{name: {'id': -1000 - i, 'type': 'supergroup'} for i, name in enumerate(chats)},
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metadata.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            bot = Bot('123456:test')
+            env = {'BOT_TOKEN': '123456:test', 'ADMIN_GROUP_ID': '-1001', 'GROUP_ID': '-1002', 'CHANNEL_NAME': '@channel'}
+            with mock.patch.dict(os.environ, env), mock.patch.object(main, 'bot', bot), mock.patch.object(Bot, 'get_me', side_effect=AssertionError('getMe called')):
+                self.assertTrue(main.BotMetadata(path).load())
+                self.assertEqual(123456, bot.id)
+                self.assertEqual('test_bot', bot.username)
+
+class OrderedDispatcherTest(unittest.TestCase):
+    def test_none_update_does_not_stop_shard(self):
+        dispatcher = RecordingDispatcher(shards=1)
+        dispatcher.start_shards()
+        dispatcher.process_update(None)
+        dispatcher.process_update(make_update(5))
+        dispatcher.shard_queues[0].join()
+        self.assertTrue(dispatcher.shard_threads[0].is_alive())
+        self.assertEqual([None, 5], [update and update.effective_user.id for update in dispatcher.handled])
+        dispatcher.stop()
+        self.assertEqual([], dispatcher.shard_threads)
+
+    def test_stop_drains_accepted_updates(self):
+        dispatcher = RecordingDispatcher(shards=2)
+        dispatcher.start_shards()
+        with mock.patch.object(main, 'USER_RATE_LIMIT', 0):
+            for i in range(20):
+                dispatcher.process_update(make_update(i % 4 + 1, update_id=i + 1))
+        dispatcher.stop()
+        self.assertEqual(20, len(dispatcher.handled))
+        # Updates of one user keep their order
+        for user_id in range(1, 5):
+            ids = [update.update_id for update in dispatcher.handled if update.effective_user.id == user_id]
+            self.assertEqual(sorted(ids), ids)
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.outbox = main.Outbox(workers=2)
+        self.outbox.start()
+        self.addCleanup(self.outbox.stop, 5)
+        self.started = time.monotonic()
+        self.sent = []
+        self.flood = {}  # chat_id -> True while its next send is answered with a 2s flood wait
+
+    def send(self, chat_id, tag=None):
+        if self.flood.pop(chat_id, None):
+            raise RetryAfter(2)
+        self.sent.append((chat_id, tag, time.monotonic() - self.started))
+
+    def test_user_replies_overtake_queued_broadcasts(self):
+        self.outbox.global_bucket = main.TokenBucket(10, capacity=1)
+        for i in range(10):
+            self.outbox.submit(-100 - i, self.send, main.PRIORITY_BROADCAST, tag='broadcast')
+        time.sleep(0.15)
+        replies = [self.outbox.submit(i, self.send, main.PRIORITY_USER, tag='user') for i in range(1, 5)]
+        for future in replies:
+            future.result(timeout=5)
+        tags = [tag for _, tag, _ in self.sent]
+        first_user = tags.index('user')
+        self.assertEqual(['user'] * 4, tags[first_user:first_user + 4])
+        self.assertLess(first_user, 4)
+
+    def test_group_flood_wait_does_not_stall_user_replies(self):
+        self.flood[-100] = True
+        group = self.outbox.submit(-100, self.send, main.PRIORITY_ADMIN)
+        time.sleep(0.1)
+        self.outbox.submit(42, self.send, main.PRIORITY_USER).result(timeout=5)
+        self.assertLess(self.sent[0][2], 1)
+        group.result(timeout=5)
+        self.assertGreaterEqual(self.sent[-1][2], 2)
+
+    def test_flood_waits_across_chats_pause_every_send(self):
+        for chat_id in (-100, -101, -102):
+            self.flood[chat_id] = True
+        floods = [self.outbox.submit(chat_id, self.send) for chat_id in (-100, -101, -102)]
+        time.sleep(0.1)
+        self.outbox.submit(42, self.send).result(timeout=5)
+        self.assertGreaterEqual(self.sent[0][2], 1.9)
+        for future in floods:
+            future.result(timeout=5)
+
+class InviteLinkTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(main, 'INVITE_SECRET', 'test-secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.invite_key.cache_clear()
+        self.addCleanup(main.invite_key.cache_clear)
+
+    def test_signed_payload_round_trip(self):
+        for user_id in (1, 123456789, 10 ** 19 - 1):
+            payload = main.invite_payload(user_id)
+            self.assertLessEqual(len(payload), 64)
+            self.assertRegex(payload, r'^[A-Za-z0-9_-]+$')
+            self.assertEqual(user_id, main.parse_invite_payload(payload))
+
+    def test_rejects_forged_payloads(self):
+        campaign, user_id, signature = main.invite_payload(42).split('-', 2)
+        forged = [
+            f'{campaign}-43-{signature}',
+            f'{campaign}-42-{signature[:-1]}',
+            f'{campaign}-42-{"A" * len(signature)}',
+            f'xx1-42-{main.sign_invite("xx1", "42")}',
+            f'{campaign}-{"9" * 20}-{main.sign_invite(campaign, "9" * 20)}',
+            f'{campaign}-4a-{main.sign_invite(campaign, "4a")}',
+            '', '42', 'garbage-payload',
+        ]
+        for payload in forged:
+            with self.subTest(payload=payload):
+                self.assertIsNone(main.parse_invite_payload(payload))
+
+    def test_retired_campaign_is_refused(self):
+        payload = main.invite_payload(42, campaign='old1')
+        self.assertIsNone(main.parse_invite_payload(payload))
+        with mock.patch.object(main, 'INVITE_CAMPAIGNS', {main.INVITE_CAMPAIGN, 'old1'}):
+            self.assertEqual(42, main.parse_invite_payload(payload))
+
+    def test_signature_depends_on_key(self):
+        payload = main.invite_payload(42)
+        main.invite_key.cache_clear()
+        with mock.patch.object(main, 'INVITE_SECRET', 'other-secret'):
+            self.assertIsNone(main.parse_invite_payload(payload))
+
+    def test_legacy_links(self):
+        with mock.patch.object(main, 'legacy_inviters', frozenset({42})):
+            self.assertIsNone(main.parse_invite_payload('42_AB12C'))
+            with mock.patch.object(main, 'INVITE_LEGACY_DEADLINE', main.datetime.now() + main.timedelta(days=1)):
+                self.assertEqual(42, main.parse_invite_payload('42_AB12C'))
+                self.assertIsNone(main.parse_invite_payload('43_AB12C'))
+                self.assertIsNone(main.parse_invite_payload('42_ab12c'))
+            with mock.patch.object(main, 'INVITE_LEGACY_DEADLINE', main.datetime.now()):
+                self.assertIsNone(main.parse_invite_payload('42_AB12C'))
+
+class WebhookTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(main, 'WEBHOOK_SECRET', 's3cret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dispatcher = mock.Mock(update_queue=Queue())
+        self.server = main.WebhookServer(self.dispatcher, address=('127.0.0.1', 0))
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def post(self, body: bytes, secret: str = 's3cret') -> int:
+        host, port = self.server.server_address[:2]
+        request = urllib.request.Request(f'http://{host}:{port}{main.WEBHOOK_PATH}', data=body, headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_rejects_bodies_without_an_update(self):
+        for body in (b'{}', b'null', b'[]', b'1', b'"x"', b'not json', b'{"foo": 1}', b'\xff'):
+            with self.subTest(body=body):
+                self.assertEqual(400, self.post(body))
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+    def test_rejects_wrong_secret(self):
+        self.assertEqual(403, self.post(json.dumps(make_update(5).to_dict()).encode(), secret=''))
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+    def test_queues_update(self):
+        self.assertEqual(200, self.post(json.dumps(make_update(5).to_dict()).encode()))
+        self.assertEqual(5, self.dispatcher.update_queue.get_nowait().effective_user.id)
+
+    def test_refuses_to_start_without_secret(self):
+        with mock.patch.object(main, 'BOT_MODE', 'webhook'), mock.patch.object(main, 'WEBHOOK_SECRET', ''), mock.patch.object(main, 'create_app') as create_app:
+            with self.assertRaises(SystemExit):
+                main.main()
+        create_app.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()